@@ -0,0 +1,149 @@
+import json
+from collections import Counter
+from dataclasses import dataclass
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple, Union
+
+# fields of an annotation (and of its bodies) that differ between runs or edits without a difference in content
+VOLATILE_FIELDS = ("id", "generated", "modified", "created")
+# body field of an observation referring to the annotations it is derived from (by identifier)
+DERIVED_FROM = "prov:wasDerivedFrom"
+
+# An annotation and its content key
+Keyed = Tuple[dict, str]
+
+
+@dataclass(frozen=True)
+class Target:
+    source: str
+    start: int
+    end: int
+    exact: str
+
+
+def extract_target(target: Union[list, dict]) -> Target:
+    """Same as extract_target() in process-results/process-evaluation-results.py, so annotations are aligned the same
+    way as in the evaluation"""
+    if isinstance(target, list):
+        for t in target:
+            if t['type'] == 'Text':
+                return extract_target(t)
+        raise Exception("Unable to extract target")
+    else:
+        if "source" in target:
+            source = target["source"]
+        else:
+            source = ""
+        start = None
+        end = None
+        exact = ""
+        for s in target['selector']:
+            if s['type'] == 'TextPositionSelector':
+                start = s['start']
+                end = s['end']
+            elif s['type'] == 'TextQuoteSelector':
+                exact = s['exact']
+        if start is None or end is None:
+            raise ValueError("No start/end found")
+        return Target(source=source, start=start, end=end, exact=exact)
+
+
+def content_key(annotation: dict, annotations_by_id: Optional[Dict[str, dict]] = None,
+                _seen: FrozenSet[str] = frozenset()) -> str:
+    """The content of an annotation that matters when comparing versions: everything but its identifier and
+    timestamps, the timestamps of its bodies, and the source of its targets (the scan, whose identifier differs
+    between runs). Nested identifiers, like the source of a tagging body, are content. References to other
+    annotations (prov:wasDerivedFrom of an observation) are replaced by the content key of the annotation referred
+    to, looked up in annotations_by_id, as its identifier differs between runs too."""
+
+    def without(value: Any, fields) -> Any:
+        if isinstance(value, list):
+            return [without(v, fields) for v in value]
+        elif isinstance(value, dict):
+            return {k: v for k, v in value.items() if k not in fields}
+        return value
+
+    def resolve(reference: str) -> str:
+        referenced = annotations_by_id.get(reference) if annotations_by_id else None
+        if referenced is None or reference in _seen:
+            return reference
+        return content_key(referenced, annotations_by_id, _seen | {reference})
+
+    content = without(annotation, VOLATILE_FIELDS)
+    if "body" in content:
+        content["body"] = without(content["body"], VOLATILE_FIELDS)
+        for body in content["body"] if isinstance(content["body"], list) else [content["body"]]:
+            if isinstance(body, dict) and DERIVED_FROM in body:
+                references = body[DERIVED_FROM]
+                body[DERIVED_FROM] = [resolve(reference) for reference in references] \
+                    if isinstance(references, list) else resolve(references)
+    if "target" in content:
+        content["target"] = without(content["target"], ("source",))
+    return json.dumps(content, sort_keys=True)
+
+
+def with_content_keys(annotations: List[dict]) -> List[Keyed]:
+    """Pairs the annotations of a version with their content keys"""
+    annotations_by_id = {annotation["id"]: annotation for annotation in annotations if annotation.get("id")}
+    return [(annotation, content_key(annotation, annotations_by_id)) for annotation in annotations]
+
+
+def group_by_span(annotations: List[Keyed]) -> Tuple[Dict[Tuple[int, int], Tuple[str, List[Keyed]]], List[Keyed]]:
+    """Groups annotations by the range of their TextPositionSelector, returns the groups (with the exact text) and the
+    annotations without a text position"""
+    spans = {}
+    unaligned = []
+    for annotation, key in annotations:
+        try:
+            target = extract_target(annotation['target'])
+        except Exception:
+            unaligned.append((annotation, key))
+            continue
+        spans.setdefault((target.start, target.end), (target.exact, []))[1].append((annotation, key))
+    return spans, unaligned
+
+
+def difference(annotations1: List[Keyed], annotations2: List[Keyed]) -> List[dict]:
+    """The annotations in the first list that have no counterpart (by content) in the second"""
+    remaining = Counter(key for _, key in annotations2)
+    result = []
+    for annotation, key in annotations1:
+        if remaining[key] > 0:
+            remaining[key] -= 1
+        else:
+            result.append(annotation)
+    return result
+
+
+def diff_annotations(annotations1: List[dict], annotations2: List[dict]) -> Dict[str, Any]:
+    """Compares two versions of the annotations of a page, aligned by text position. Returns the spans that only have
+    annotations in the second version (added), only in the first (removed), or different annotations in each
+    (changed), in text order, and the number of spans whose annotations are the same (unchanged). For a changed span
+    only the annotations that differ are included. Annotations without a text position are compared by content."""
+    spans1, unaligned1 = group_by_span(with_content_keys(annotations1))
+    spans2, unaligned2 = group_by_span(with_content_keys(annotations2))
+    added, removed, changed = [], [], []
+    unchanged = 0
+    for start, end in sorted(spans1.keys() | spans2.keys()):
+        span = {"start": start, "end": end}
+        if (start, end) not in spans1:
+            exact, annotations = spans2[(start, end)]
+            added.append({**span, "exact": exact, "annotations": [annotation for annotation, _ in annotations]})
+        elif (start, end) not in spans2:
+            exact, annotations = spans1[(start, end)]
+            removed.append({**span, "exact": exact, "annotations": [annotation for annotation, _ in annotations]})
+        else:
+            exact, before = spans1[(start, end)]
+            _, after = spans2[(start, end)]
+            if Counter(key for _, key in before) == Counter(key for _, key in after):
+                unchanged += 1
+            else:
+                # only the annotations that differ, the ones both versions have are left out
+                changed.append({**span, "exact": exact, "from": difference(before, after),
+                                "to": difference(after, before)})
+    unaligned_added = difference(unaligned2, unaligned1)
+    unaligned_removed = difference(unaligned1, unaligned2)
+    if unaligned_added:
+        added.append({"start": None, "end": None, "exact": None, "annotations": unaligned_added})
+    if unaligned_removed:
+        removed.append({"start": None, "end": None, "exact": None, "annotations": unaligned_removed})
+    return {"added": added, "removed": removed, "changed": changed, "unchanged": unchanged}
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from datastore import DataStore
+
+ANNOTATORS = ("harm", "jirsi", "judith")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    basename TEXT NOT NULL,
+    version TEXT NOT NULL,
+    modified REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (basename, version)
+);
+CREATE TABLE IF NOT EXISTS annotations (
+    basename TEXT NOT NULL,
+    version TEXT NOT NULL,
+    key TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    annotation TEXT NOT NULL,
+    PRIMARY KEY (basename, version, key)
+);
+CREATE TABLE IF NOT EXISTS checks (
+    basename TEXT NOT NULL,
+    annotator TEXT NOT NULL,
+    checked INTEGER NOT NULL,
+    PRIMARY KEY (basename, annotator)
+);
+"""
+
+
+def annotation_keys(annotations: List[dict]) -> List[str]:
+    """Identifies the annotations of a page by their id; by position if they have none or the id is not unique"""
+    keys = []
+    seen = set()
+    for position, annotation in enumerate(annotations):
+        key = annotation.get('id') if isinstance(annotation, dict) else None
+        if not key or key in seen:
+            key = f"@{position}"
+        seen.add(key)
+        keys.append(key)
+    return keys
+
+
+class AnnotationStore:
+    """SQLite database (in WAL mode, so reads are not blocked by a save) holding the annotations per page and version,
+    and the check state per page and annotator.
+
+    A page and version is imported from its JSON file in the data directory the first time it is requested, the checks
+    are imported from checked.json when the database is created. From then on the database is authoritative; use
+    export() (or run this module) to write the JSON files that process-evaluation-results.py reads.
+
+    Saves are incremental: only added, changed and removed annotations (by id) and changed checks are written, in one
+    transaction per save. Every thread gets its own connection."""
+
+    def __init__(self, filename: str, datastore: DataStore):
+        self.filename = filename
+        self.datastore = datastore
+        self._local = threading.local()
+        connection = self.connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(SCHEMA)
+        if 'modified' not in [column[1] for column in connection.execute("PRAGMA table_info(pages)")]:
+            # stores created before modification times were recorded
+            connection.execute("ALTER TABLE pages ADD COLUMN modified REAL NOT NULL DEFAULT 0")
+        checkfile_path = datastore.path('checked.json')
+        if os.path.exists(checkfile_path):
+            connection = self._transaction()
+            try:
+                (checks,) = connection.execute("SELECT count(*) FROM checks").fetchone()
+                if not checks:
+                    for basename, checked in datastore.load_json(checkfile_path).items():
+                        self._set_checks(connection, basename, checked)
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.filename, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _transaction(self) -> sqlite3.Connection:
+        # take the write lock at the start, so concurrent saves wait rather than fail when upgrading a read lock
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        return connection
+
+    def versions(self) -> List[str]:
+        """The versions in the database and in the data directory"""
+        versions = {version for (version,) in self.connection().execute("SELECT DISTINCT version FROM pages")}
+        return sorted(versions | set(self.datastore.versions()))
+
+    def has_page(self, basename: str, version: str) -> bool:
+        return self.connection().execute("SELECT 1 FROM pages WHERE basename = ? AND version = ?",
+                                         (basename, version)).fetchone() is not None
+
+    def import_page(self, basename: str, version: str) -> bool:
+        """Imports the annotations of a page and version from the JSON file, returns False if there is none"""
+        annotations_file = self.datastore.annotation_file(basename, version)
+        if annotations_file is None:
+            return False
+        annotations = self.datastore.load_json(annotations_file)
+        connection = self._transaction()
+        try:
+            # another request may have imported it meanwhile
+            if not self.has_page(basename, version):
+                connection.execute("INSERT INTO pages (basename, version, modified) VALUES (?, ?, ?)",
+                                   (basename, version, os.stat(annotations_file).st_mtime))
+                connection.executemany(
+                    "INSERT INTO annotations (basename, version, key, position, annotation) VALUES (?, ?, ?, ?, ?)",
+                    ((basename, version, key, position, json.dumps(annotation))
+                     for position, (key, annotation) in enumerate(zip(annotation_keys(annotations), annotations))))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return True
+
+    def annotations(self, basename: str, version: str) -> Optional[List[dict]]:
+        """Returns the annotations of a page and version, in order, or None if there are none"""
+        if not self.has_page(basename, version) and not self.import_page(basename, version):
+            return None
+        rows = self.connection().execute(
+            "SELECT annotation FROM annotations WHERE basename = ? AND version = ? ORDER BY position",
+            (basename, version))
+        # parsing the page at once is considerably faster than parsing each annotation
+        return json.loads("[" + ",".join(annotation for (annotation,) in rows) + "]")
+
+    def save(self, basename: str, version: str, annotations: List[dict], checked: Dict[str, Any]) \
+            -> Tuple[int, int, int]:
+        """Saves the annotations of a page and version and the checks of the page, returns the number of annotations
+        added, changed and removed"""
+        if not self.has_page(basename, version):
+            # so annotations that were not changed are not considered new
+            self.import_page(basename, version)
+        added = changed = 0
+        connection = self._transaction()
+        try:
+            connection.execute("INSERT OR IGNORE INTO pages (basename, version) VALUES (?, ?)", (basename, version))
+            # the checks are shown with every version of the page
+            connection.execute("UPDATE pages SET modified = ? WHERE basename = ?", (time.time(), basename))
+            stored = {key: (position, annotation) for key, position, annotation in connection.execute(
+                "SELECT key, position, annotation FROM annotations WHERE basename = ? AND version = ?",
+                (basename, version))}
+            keys = annotation_keys(annotations)
+            for position, (key, annotation) in enumerate(zip(keys, annotations)):
+                annotation = json.dumps(annotation)
+                if key not in stored:
+                    connection.execute(
+                        "INSERT INTO annotations (basename, version, key, position, annotation) VALUES (?, ?, ?, ?, ?)",
+                        (basename, version, key, position, annotation))
+                    added += 1
+                elif stored[key] != (position, annotation):
+                    connection.execute("UPDATE annotations SET position = ?, annotation = ? "
+                                       "WHERE basename = ? AND version = ? AND key = ?",
+                                       (position, annotation, basename, version, key))
+                    changed += 1
+            removed = set(stored) - set(keys)
+            connection.executemany("DELETE FROM annotations WHERE basename = ? AND version = ? AND key = ?",
+                                   ((basename, version, key) for key in removed))
+            self._set_checks(connection, basename, checked)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return added, changed, len(removed)
+
+    def modified(self, basename: str, version: str) -> float:
+        """Returns when the annotations of a page and version, or the checks of the page, were last modified (as a
+        timestamp), 0 if unknown"""
+        row = self.connection().execute("SELECT modified FROM pages WHERE basename = ? AND version = ?",
+                                        (basename, version)).fetchone()
+        return row[0] if row else 0
+
+    @staticmethod
+    def _set_checks(connection: sqlite3.Connection, basename: str, checked: Dict[str, Any]):
+        connection.executemany(
+            "INSERT INTO checks (basename, annotator, checked) VALUES (?, ?, ?) "
+            "ON CONFLICT (basename, annotator) DO UPDATE SET checked = excluded.checked "
+            "WHERE checked != excluded.checked",
+            ((basename, annotator, bool(value)) for annotator, value in checked.items()))
+
+    def checks(self, basenames: List[str]) -> Dict[str, Dict[str, bool]]:
+        """Returns the checks per page and annotator (False if not set)"""
+        checks = {basename: {annotator: False for annotator in ANNOTATORS} for basename in basenames}
+        for basename, annotator, checked in self.connection().execute(
+                "SELECT basename, annotator, checked FROM checks"):
+            checks.setdefault(basename, {annotator: False for annotator in ANNOTATORS})[annotator] = bool(checked)
+        return checks
+
+    def page_checks(self, basename: str) -> Dict[str, bool]:
+        checks = {annotator: False for annotator in ANNOTATORS}
+        for annotator, checked in self.connection().execute(
+                "SELECT annotator, checked FROM checks WHERE basename = ?", (basename,)):
+            checks[annotator] = bool(checked)
+        return checks
+
+    def export(self, destination_dir: str, versions: Optional[List[str]] = None) -> int:
+        """Writes the annotations of every page and version to {basename}.{version}.json and the checks to
+        checked.json in the destination directory, like the backend used to. Pages that are not in the database
+        (never opened in the tool) are taken from the data directory. Returns the number of annotation files
+        written."""
+        os.makedirs(destination_dir, exist_ok=True)
+        exported = DataStore(destination_dir)
+        stored = set(self.connection().execute("SELECT basename, version FROM pages").fetchall())
+        count = 0
+        for basename, version in sorted(stored | set(self.datastore.pages())):
+            if versions and version not in versions:
+                continue
+            if (basename, version) in stored:
+                annotations = self.annotations(basename, version)
+            else:
+                annotations = self.datastore.load_json(self.datastore.annotation_file(basename, version))
+            exported.write_json(exported.path(f'{basename}.{version}.json'), annotations, indent=4)
+            count += 1
+        basenames = [basename for (basename,) in self.connection().execute("SELECT DISTINCT basename FROM checks")]
+        selection_file = self.datastore.path('ga-selection-basenames.json')
+        if os.path.exists(selection_file):
+            basenames += self.datastore.load_json(selection_file)
+        exported.write_json(exported.path('checked.json'), self.checks(basenames))
+        return count
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export the annotations and checks in the annotation store to JSON files ({basename}.{version}.json "
+                    "and checked.json), e.g. for process-evaluation-results.py. Pages that were never opened in the "
+                    "tool are not in the store, they are copied from the data directory (next to the store).",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--database', type=str, help="The annotation store", action='store',
+                        default='data/annotations.sqlite')
+    parser.add_argument('--destinationdir', '-d', type=str, help="Directory to write the JSON files to",
+                        action='store', required=True)
+    parser.add_argument('--version', '-v', type=str, help="Export only this version (may be specified multiple times)",
+                        action='append', required=False)
+    args = parser.parse_args()
+    if not os.path.exists(args.database):
+        parser.error(f"No such annotation store: {args.database}")
+    store = AnnotationStore(args.database, DataStore(os.path.dirname(args.database) or '.'))
+    count = store.export(args.destinationdir, args.version)
+    print(f"Exported {count} annotation files to {args.destinationdir}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+
+def _umask() -> int:
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# mkstemp creates files with mode 0600, written files get the mode open() would give them
+FILE_MODE = 0o666 & ~_umask()
+
+
+class DataStore:
+    """Access to the files in the data directory.
+
+    Keeps an index of the annotation files (basename -> version -> file), which is rebuilt when the modification time
+    of the directory changes (files added, removed or renamed). Parsed JSON files and text files are kept in an LRU
+    cache holding at most max_bytes (measured by file size); a cached file is read again when its modification time or
+    size has changed. Cached values are shared, callers must not modify them.
+
+    Files are written atomically (to a temporary file that is renamed), so readers never see a partially written
+    file. The methods are thread-safe, they are called from the web server's thread pool."""
+
+    def __init__(self, data_dir: str = 'data', max_bytes: int = 64 * 1024 * 1024):
+        self.data_dir = data_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._index: Dict[str, Dict[str, str]] = {}
+        self._index_mtime = None
+        self._cache: "OrderedDict[str, Tuple[Tuple[int, int], int, Any]]" = OrderedDict()
+        self._cached_bytes = 0
+
+    def path(self, filename: str) -> str:
+        return os.path.join(self.data_dir, filename)
+
+    def _annotation_index(self) -> Dict[str, Dict[str, str]]:
+        mtime = os.stat(self.data_dir).st_mtime_ns
+        with self._lock:
+            if mtime != self._index_mtime:
+                index = {}
+                for annotation_file in os.listdir(self.data_dir):
+                    if annotation_file.endswith('.json'):
+                        parts = annotation_file.split('.')
+                        if len(parts) == 3:
+                            index.setdefault(parts[0], {})[parts[1]] = self.path(annotation_file)
+                self._index = index
+                self._index_mtime = mtime
+            return self._index
+
+    def versions(self) -> List[str]:
+        return sorted({version for versions in self._annotation_index().values() for version in versions})
+
+    def pages(self) -> List[Tuple[str, str]]:
+        """Returns the basename and version of every annotation file"""
+        return [(basename, version) for basename, versions in self._annotation_index().items() for version in versions]
+
+    def annotation_file(self, basename: str, version: str) -> Optional[str]:
+        """Returns the path of the annotation file of a basename and version, or None if there is none"""
+        return self._annotation_index().get(basename, {}).get(version)
+
+    def load_json(self, filepath: str) -> Any:
+        return self._load(filepath, json.load)
+
+    def load_text(self, filepath: str) -> str:
+        return self._load(filepath, lambda f: f.read())
+
+    def _load(self, filepath: str, parse) -> Any:
+        stat = os.stat(filepath)
+        state = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._cache.get(filepath)
+            if entry is not None and entry[0] == state:
+                self._cache.move_to_end(filepath)
+                return entry[2]
+        with open(filepath, encoding='utf8') as f:
+            value = parse(f)
+        with self._lock:
+            self._put(filepath, state, stat.st_size, value)
+        return value
+
+    def _put(self, filepath: str, state: Tuple[int, int], size: int, value: Any):
+        old = self._cache.pop(filepath, None)
+        if old is not None:
+            self._cached_bytes -= old[1]
+        if size > self.max_bytes:
+            return
+        self._cache[filepath] = (state, size, value)
+        self._cached_bytes += size
+        while self._cached_bytes > self.max_bytes:
+            _, (_, evicted_size, _) = self._cache.popitem(last=False)
+            self._cached_bytes -= evicted_size
+
+    def write_json(self, filepath: str, value: Any, **kwargs):
+        """Writes a JSON file atomically, kwargs are passed to json.dump()"""
+        directory = os.path.dirname(filepath) or "."
+        fd, tmpfile = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(filepath)}.", suffix=".tmp")
+        try:
+            os.fchmod(fd, FILE_MODE)
+            with os.fdopen(fd, 'w', encoding='utf8') as f:
+                json.dump(value, f, **kwargs)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmpfile, filepath)
+        except BaseException:
+            os.unlink(tmpfile)
+            raise
+        finally:
+            self.invalidate(filepath)
+
+    def invalidate(self, filepath: str):
+        """Drops a file from the cache (after writing it)"""
+        with self._lock:
+            old = self._cache.pop(filepath, None)
+            if old is not None:
+                self._cached_bytes -= old[1]
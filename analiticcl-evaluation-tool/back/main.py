@@ -1,16 +1,22 @@
 #!/usr/bin/env python3
 
-import json
+import hashlib
 import os
+from email.utils import formatdate, parsedate_to_datetime
 from typing import Dict, Any, List
 
 import markdown
 import uvicorn
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import HTMLResponse, JSONResponse
 from pydantic import BaseModel
 
+from annotationdiff import diff_annotations
+from annotationstore import AnnotationStore
+from datastore import DataStore
+
 app = FastAPI()
 
 origins = [
@@ -26,25 +32,14 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# compress larger responses (the page data) for clients that accept it
+app.add_middleware(GZipMiddleware, minimum_size=1000)
 
-checkfile_path = 'data/checked.json'
-checks = {}
-
-
-def load_checks():
-    global checks
-    if os.path.exists(checkfile_path):
-        with open(checkfile_path) as f:
-            checks = json.load(f)
-    else:
-        default = {"harm": False,"jirsi": False, "judith": False}
-        for a in load_basenames():
-            checks[a] = default
-
-
-def save_checks():
-    with open(checkfile_path, 'w') as f:
-        return json.dump(checks, f)
+# Handlers that read or write files are plain functions: FastAPI runs those in its thread pool, so slow disk I/O
+# does not block the event loop (and other requests)
+store = DataStore('data')
+# annotations and checks are saved in the annotation store, run annotationstore.py to export them as JSON files
+annotation_store = AnnotationStore(store.path('annotations.sqlite'), store)
 
 
 @app.get("/")
@@ -53,59 +48,88 @@ async def root():
 
 
 @app.get("/versions")
-async def get_versions():
-    versions = set()
-    for annotation_file in os.listdir('data'):
-        if annotation_file.endswith('.json'):
-            parts = annotation_file.split('.')
-            if len(parts) == 3:
-                versions.add(parts[1])
-    return sorted(list(versions))
+def get_versions():
+    return annotation_store.versions()
 
 
 @app.get("/basenames")
-async def get_basenames():
+def get_basenames():
     return load_basenames()
 
 @app.get("/checks")
-async def get_checks():
-    load_checks()
-    return checks
+def get_checks():
+    return annotation_store.checks(load_basenames())
 
 
 def load_basenames():
-    with open('data/ga-selection-basenames.json') as f:
-        return json.load(f)
+    return store.load_json(store.path('ga-selection-basenames.json'))
 
 def load_url_dict():
-    with open('data/page-selection.json') as f:
-        return json.load(f)
+    return store.load_json(store.path('page-selection.json'))
 
 
 @app.get("/pagedata/{basename}/{version}")
-async def get_page_data(basename: str, version: str):
+def get_page_data(basename: str, version: str, request: Request):
     transkribus_url = load_url_dict()
-    load_checks()
-    text_file = f'data/{basename}.txt'
+    text_file = store.path(f'{basename}.txt')
     if not os.path.exists(text_file):
         _file_not_found(text_file)
-    with open(text_file, encoding='utf8') as f:
-        text = f.read()
-    annotations_file = f'data/{basename}.{version}.json'
-    if not os.path.exists(annotations_file):
-        _file_not_found(annotations_file)
-    with open(annotations_file, encoding='utf8') as f:
-        annotations = json.load(f)
-    return {
+    text = store.load_text(text_file)
+    annotations = annotation_store.annotations(basename, version)
+    if annotations is None:
+        _file_not_found(store.path(f'{basename}.{version}.json'))
+    checks = annotation_store.page_checks(basename)
+    last_modified = max(os.stat(text_file).st_mtime, os.stat(store.path('page-selection.json')).st_mtime,
+                        annotation_store.modified(basename, version))
+    return _conditional_response(request, {
         "text": text,
         "annotations": annotations,
         "transkribus_url": transkribus_url[basename],
         "checked": {
-            "harm": checks[basename]['harm'],
-            "jirsi": checks[basename]['jirsi'],
-            "judith": checks[basename]['judith']
+            "harm": checks['harm'],
+            "jirsi": checks['jirsi'],
+            "judith": checks['judith']
         }
-    }
+    }, last_modified)
+
+
+@app.get("/diff/{basename}/{v1}/{v2}")
+def get_diff(basename: str, v1: str, v2: str, request: Request):
+    """Returns only the annotations that differ between two versions of a page, aligned by text position"""
+    annotations = {}
+    for version in (v1, v2):
+        annotations[version] = annotation_store.annotations(basename, version)
+        if annotations[version] is None:
+            _file_not_found(store.path(f'{basename}.{version}.json'))
+    last_modified = max(annotation_store.modified(basename, v1), annotation_store.modified(basename, v2))
+    return _conditional_response(request, {
+        "basename": basename,
+        "from": v1,
+        "to": v2,
+        **diff_annotations(annotations[v1], annotations[v2])
+    }, last_modified)
+
+
+def _conditional_response(request: Request, content: Any, last_modified: float) -> Response:
+    """Returns the content as JSON with an ETag (a hash of the JSON) and Last-Modified header, or 304 Not Modified if
+    the client's copy (If-None-Match, or else If-Modified-Since) is still current. Clients have to revalidate every
+    time (no-cache), so a page never shows stale annotations after a save."""
+    response = JSONResponse(content)
+    etag = f'"{hashlib.sha1(response.body).hexdigest()}"'
+    headers = {"ETag": etag, "Last-Modified": formatdate(last_modified, usegmt=True), "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # a compressing proxy (like nginx) marks the ETag weak
+        not_modified = any(tag.strip() in ("*", etag, f"W/{etag}") for tag in if_none_match.split(","))
+    else:
+        try:
+            not_modified = int(last_modified) <= parsedate_to_datetime(request.headers["if-modified-since"]).timestamp()
+        except (KeyError, TypeError, ValueError):
+            not_modified = False
+    if not_modified:
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return response
 
 
 class AnnotationUpdateBody(BaseModel):
@@ -114,18 +138,14 @@ class AnnotationUpdateBody(BaseModel):
 
 
 @app.put("/annotations/{basename}/{version}")
-async def put_annotations(basename: str, version: str, aub: AnnotationUpdateBody):
-    annotations = aub.annotations
-    with open(f'data/{basename}.{version}.json', 'w', encoding='utf8') as f:
-        json.dump(annotations, f, indent=4)
-    load_checks()
-    checks[basename] = aub.checked
-    save_checks()
+def put_annotations(basename: str, version: str, aub: AnnotationUpdateBody):
+    # only the changed annotations and checks are written, in one transaction
+    annotation_store.save(basename, version, aub.annotations, aub.checked)
     return aub
 
 
 @app.get("/html/{filename}.html", response_class=HTMLResponse)
-async def get_html(filename: str):
+def get_html(filename: str):
     filepath = f'doc/{filename}.md'
     if not os.path.exists(filepath):
         _file_not_found(filepath)
@@ -0,0 +1,64 @@
+import copy
+
+from annotationdiff import content_key, diff_annotations
+
+FIRSTNAME = "https://data.goldenagents.org/thesaurus/firstname"
+MATERIAL = "https://data.goldenagents.org/thesaurus/material"
+FAMILYNAME = "https://data.goldenagents.org/thesaurus/familyname"
+
+
+def annotation(annotation_id: str, scan: str, tag: str) -> dict:
+    return {
+        "id": annotation_id,
+        "type": "Annotation",
+        "generated": "2022-10-12T10:00:00",
+        "body": [{"type": "SpecificResource", "purpose": "tagging", "source": {"id": tag},
+                  "modified": "2022-10-12T10:00:00"}],
+        "target": [{"type": "Text", "source": scan,
+                    "selector": [{"type": "TextPositionSelector", "start": 32, "end": 39},
+                                 {"type": "TextQuoteSelector", "exact": "Niclaas"}]}],
+    }
+
+
+def test_ids_timestamps_and_target_source_are_ignored():
+    before = annotation("a1", "https://example.org/scans/1", FIRSTNAME)
+    after = annotation("a2", "https://example.org/scans/2", FIRSTNAME)
+    after["generated"] = after["body"][0]["modified"] = "2022-10-13T10:00:00"
+    assert content_key(before) == content_key(after)
+    assert diff_annotations([before], [after]) == {"added": [], "removed": [], "changed": [], "unchanged": 1}
+
+
+def test_body_source_change_is_a_change():
+    before = annotation("a1", "https://example.org/scans/1", FIRSTNAME)
+    after = copy.deepcopy(before)
+    after["body"][0]["source"]["id"] = MATERIAL
+    assert content_key(before) != content_key(after)
+    diff = diff_annotations([before], [after])
+    assert diff["unchanged"] == 0
+    assert [(span["start"], span["end"], span["exact"]) for span in diff["changed"]] == [(32, 39, "Niclaas")]
+    assert diff["changed"][0]["from"] == [before]
+    assert diff["changed"][0]["to"] == [after]
+
+
+def observation(annotation_id: str, derived_from: list) -> dict:
+    return {
+        "id": annotation_id,
+        "type": "Annotation",
+        "body": {"type": "https://data.goldenagents.org/ontology/rpp/Person", "label": "Niclaas Hulft",
+                 "prov:wasDerivedFrom": derived_from},
+        "target": [{"type": "Text", "source": "https://example.org/scans/1",
+                    "selector": [{"type": "TextPositionSelector", "start": 32, "end": 45},
+                                 {"type": "TextQuoteSelector", "exact": "Niclaas Hulft"}]}],
+    }
+
+
+def test_reidentified_observations_are_unchanged():
+    def version(prefix: str) -> list:
+        firstname = annotation(f"{prefix}1", "https://example.org/scans/1", FIRSTNAME)
+        familyname = annotation(f"{prefix}2", "https://example.org/scans/1", FAMILYNAME)
+        familyname["target"][0]["selector"] = [{"type": "TextPositionSelector", "start": 40, "end": 45},
+                                               {"type": "TextQuoteSelector", "exact": "Hulft"}]
+        return [firstname, familyname, observation(f"{prefix}3", [f"{prefix}1", f"{prefix}2"])]
+
+    assert diff_annotations(version("a"), version("b")) == {"added": [], "removed": [], "changed": [],
+                                                             "unchanged": 3}
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+import argparse
+import csv
+import glob
+import json
+import os.path
+import resource
+import sys
+import tempfile
+import time
+from collections import Counter
+from types import SimpleNamespace
+from typing import List, Optional
+
+from golden_agents_ner.boedeltermen import BOEDELTERMEN_NORMWORDFORM, BOEDELTERMEN_TYPE
+from golden_agents_ner.cli import iter_inputfiles
+from golden_agents_ner.ner import NER, NoArchiveIDError
+from golden_agents_ner.profiling import STAGES
+from golden_agents_ner.writer import OutputWriter
+
+# Location of the repository when running from a checkout; used to find the bundled resources and evaluation texts
+REPOROOT = os.path.realpath(os.path.join(os.path.dirname(__file__), "..", ".."))
+DEFAULT_RESOURCEDIR = os.path.join(REPOROOT, "resources")
+DEFAULT_TEXTDIR = os.path.join(REPOROOT, "analiticcl-evaluation-tool", "back", "data")
+
+
+class TextScan:
+    """A scan read from a plain text file (one line per text line) with made-up coordinates, so plain texts can be
+    passed through the same pipeline as PageXML scans"""
+
+    def __init__(self, filename: str):
+        basename = os.path.splitext(os.path.basename(filename))[0]
+        self.id = basename
+        self.pid = f"https://data.goldenagents.org/datasets/benchmark/scans/{basename}"
+        self.text_pid = f"https://data.goldenagents.org/datasets/benchmark/texts/{basename}"
+        with open(filename, 'r', encoding='utf-8') as f:
+            self.lines = [SimpleNamespace(id=f"line{i}", text=line.rstrip("\n"),
+                                          coords=SimpleNamespace(x=0, y=i * 50, w=1000, h=50))
+                          for i, line in enumerate(f)]
+
+    def get_lines(self):
+        return self.lines
+
+
+def synthetic_config(resourcedir: str, workdir: str) -> str:
+    """Writes a configuration using only the small lexicons that are bundled with the repository, returns its path"""
+    objects = set()
+    with open(os.path.join(resourcedir, "boedeltermen.csv"), 'r', encoding='utf-8', newline='') as f, \
+            open(os.path.join(workdir, "boedeltermen.csv"), 'w', encoding='utf-8', newline='') as out:
+        writer = csv.writer(out)
+        for fields in csv.reader(f):
+            if len(fields) == 5 and fields[BOEDELTERMEN_TYPE] == "voorwerp":
+                objects.add(fields[BOEDELTERMEN_NORMWORDFORM])
+                fields[BOEDELTERMEN_TYPE] = "object"
+                writer.writerow(fields)
+    with open(os.path.join(workdir, "objects.tsv"), 'w', encoding='utf-8') as f:
+        for word in sorted(objects):
+            f.write(f"{word}\n")
+    # annotations are only produced for tagged matches, so tag every match in one of the lexicons
+    contextrules = os.path.join(workdir, "contextrules.tsv")
+    with open(contextrules, 'w', encoding='utf-8') as f:
+        for lexicon, tag in (("objects.tsv", "object"), ("occupations.tsv", "occupation"),
+                             ("countries.lst", "country"), ("regions.lst", "region")):
+            f.write(f"@{lexicon}\t1.0\t{tag}\n")
+    config = {
+        "alphabet": os.path.join(resourcedir, "simple.alphabet.tsv"),
+        "lexicons": {
+            "object": os.path.join(workdir, "objects.tsv"),
+            "occupation": os.path.join(resourcedir, "lexicons", "occupations.tsv"),
+            "country": os.path.join(resourcedir, "lexicons", "countries.lst"),
+            "region": os.path.join(resourcedir, "lexicons", "regions.lst"),
+        },
+        "resourceids": {
+            "object": "http://vocab.getty.edu/aat/300311889",
+            "occupation": "http://vocab.getty.edu/aat/300263369",
+            "country": "http://vocab.getty.edu/aat/300387506",
+            "region": "http://vocab.getty.edu/aat/300182722",
+        },
+        "observationids": {},
+        "contextrules": contextrules,
+        "searchparameters": {
+            "max_edit_distance": "0.7;4",
+            "max_anagram_distance": "0.7;4",
+            "max_ngram": 2,
+            "cutoff_threshold": 1.4,
+            "score_threshold": 0.5,
+            "max_matches": 20,
+            "freq_weight": 0.25,
+        },
+        "weights": {"ld": 0.55, "lcs": 0.15, "prefix": 0.15, "suffix": 0.15, "case": 0},
+        "htr_corrections": os.path.join(resourcedir, "htr_corrections.json"),
+        "archive_identifiers": os.path.join(resourcedir, "archive_identifiers.csv"),
+        "boedeltermen": os.path.join(workdir, "boedeltermen.csv"),
+    }
+    configfile = os.path.join(workdir, "nerconfig.benchmark.json")
+    with open(configfile, 'w', encoding='utf-8') as f:
+        json.dump(config, f, indent=4)
+    return configfile
+
+
+def resources_available(configfile: str) -> bool:
+    """Checks whether all lexicons and variant lists referenced by a configuration exist"""
+    with open(configfile, 'rb') as f:
+        config = json.load(f)
+    for key in ('lexicons', 'variantlists'):
+        for filepath in config.get(key, {}).values():
+            if filepath[0] != '/':
+                filepath = os.path.join(os.path.dirname(configfile), filepath)
+            if not os.path.exists(filepath):
+                print(f"Resource {filepath} not found", file=sys.stderr)
+                return False
+    return True
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux (bytes on macOS)
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        maxrss /= 1024
+    return maxrss / 1024
+
+
+def analiticcl_version() -> Optional[str]:
+    try:
+        from importlib.metadata import version
+        return version('analiticcl')
+    except Exception:
+        return None
+
+
+def add_write_time(write_time: float, statistics: Counter):
+    statistics["time_serialization"] += write_time
+    statistics["calls_serialization"] += 1
+
+
+def benchmark(configfile: str, scans: List, repeat: int = 1) -> dict:
+    """Runs the pipeline over the scans (without caching) and returns the measurements. The output is written to a
+    temporary directory by a background writer, as golden-agents-ner does."""
+    start = time.perf_counter()
+    ner = NER(configfile, profile=True)
+    startup = time.perf_counter() - start
+    statistics = None
+    for _ in range(repeat):
+        ner.pop_statistics()
+        written = Counter()
+        with tempfile.TemporaryDirectory() as outdir, OutputWriter() as writer:
+            for scan in scans:
+                annotations, plain_text, raw_results = ner.create_web_annotations(scan)
+                writer.submit([
+                    (os.path.join(outdir, f"{scan.id}.json"),
+                     lambda f, annotations=annotations: json.dump(obj=annotations, fp=f, indent=4, ensure_ascii=False)),
+                    (os.path.join(outdir, f"{scan.id}.txt"), lambda f, plain_text=plain_text: f.write(plain_text)),
+                ])
+                writer.when_written(add_write_time, written)
+        run = ner.pop_statistics() + written
+        if scans and not run['time_serialization']:
+            raise RuntimeError("The time spent writing the output was not measured")
+        if statistics is None or run['time_matching'] < statistics['time_matching']:
+            statistics = run
+    total = sum(statistics.get(f"time_{stage}", 0.0) for stage in STAGES)
+    return {
+        "startup_seconds": round(startup, 4),
+        "scans": statistics['scans'],
+        "lines": statistics['lines'],
+        "tokens": statistics['tokens'],
+        "matches": statistics['matches'],
+        "annotations": statistics['annotations'],
+        "stages": {stage: {"calls": statistics.get(f"calls_{stage}", 0),
+                           "seconds": round(statistics.get(f"time_{stage}", 0.0), 4)}
+                   for stage in STAGES if stage != "parse" or statistics.get("calls_parse")},
+        "lines_per_second": round(statistics['lines'] / total, 2) if total else None,
+        "matching_lines_per_second": round(statistics['lines'] / statistics['time_matching'], 2)
+        if statistics['time_matching'] else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the throughput of the NER pipeline on the bundled evaluation texts and/or PageXML "
+                    "files, outputs the results as JSON",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--config', '-c', type=str,
+                        help="Configuration file; if not set or if its resources are missing, a configuration with "
+                             "small synthetic lexicons from the bundled resources is used", action='store')
+    parser.add_argument('--resourcedir', type=str, help="Resource directory for the synthetic configuration",
+                        action='store', default=DEFAULT_RESOURCEDIR)
+    parser.add_argument('--textdir', type=str, help="Directory with plain text files (*.txt) to benchmark on",
+                        action='store', default=DEFAULT_TEXTDIR)
+    parser.add_argument('--repeat', '-n', type=int, help="Number of runs over the input, the fastest is reported",
+                        action='store', default=1)
+    parser.add_argument('--output', '-o', type=str, help="Write the results to this file instead of standard output",
+                        action='store')
+    parser.add_argument("pagexmlfiles", nargs="*",
+                        help="PageXML files (or .lst/.index files listing them), e.g. the development set", type=str)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        synthetic = not args.config or not resources_available(args.config)
+        if synthetic:
+            print("Using a synthetic configuration with the bundled lexicons", file=sys.stderr)
+            configfile = synthetic_config(args.resourcedir, workdir)
+        else:
+            configfile = args.config
+
+        results = {
+            "analiticcl": analiticcl_version(),
+            "config": None if synthetic else os.path.abspath(configfile),
+            "synthetic": synthetic,
+            "benchmarks": {},
+        }
+
+        textfiles = sorted(glob.glob(os.path.join(args.textdir, "*.txt"))) if args.textdir else []
+        if textfiles:
+            scans = [TextScan(textfile) for textfile in textfiles]
+            results["benchmarks"]["texts"] = benchmark(configfile, scans, args.repeat)
+
+        if args.pagexmlfiles:
+            # parsing is timed separately, before the pipeline runs
+            ner = NER(configfile, profile=True)
+            scans = []
+            for pagexmlfile in iter_inputfiles(*args.pagexmlfiles):
+                try:
+                    scans.append(ner.read_pagexml(pagexmlfile))
+                except NoArchiveIDError:
+                    print(f"WARNING: {pagexmlfile} has no archive identifier, skipping", file=sys.stderr)
+            parse_statistics = ner.pop_statistics()
+            del ner
+            results["benchmarks"]["pagexml"] = benchmark(configfile, scans, args.repeat)
+            results["benchmarks"]["pagexml"]["stages"]["parse"] = {
+                "calls": parse_statistics['calls_parse'], "seconds": round(parse_statistics['time_parse'], 4)}
+
+        if not results["benchmarks"]:
+            parser.error("No input: specify PageXML files and/or a directory with text files")
+
+    results["peak_rss_mb"] = round(peak_rss_mb(), 1)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=4)
+    else:
+        json.dump(results, sys.stdout, indent=4)
+        print()
+
+
+if __name__ == '__main__':
+    main()
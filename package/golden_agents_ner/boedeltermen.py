@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+import argparse
+import csv
+import pickle
+import sys
+from types import MappingProxyType
+from typing import Dict, Tuple, List
+
+from golden_agents_ner.manifest import atomic_open
+
+BOEDELTERMEN_LEMMA, BOEDELTERMEN_TYPE, BOEDELTERMEN_NORMWORDFORM, BOEDELTERMEN_VARWORDFORM, BOEDELTERMEN_URI = range(0, 5)
+BOEDELTERMEN_HEADER = ("Lemma", "Soort", "Standaard", "Aangetroffen", "URI")
+
+# Magic string identifying prebuilt boedeltermen index files
+BINARY_MAGIC = b"GANERBT1"
+
+
+class Boedeltermen:
+    """Index of the boedeltermen: maps (normalised wordform, type) tuples to (uri, lemma) pairs (may be multiple
+    because of ambiguity). The mapping is frozen once built; all strings are interned."""
+
+    def __init__(self, index: Dict[Tuple[str, str], Tuple[Tuple[str, str], ...]]):
+        self.index = MappingProxyType(index)
+
+    @classmethod
+    def from_file(cls, filename: str) -> 'Boedeltermen':
+        """Loads a prebuilt binary index or reads a boedeltermen CSV file, depending on the file's contents"""
+        with open(filename, 'rb') as f:
+            magic = f.read(len(BINARY_MAGIC))
+        if magic == BINARY_MAGIC:
+            return cls.load(filename)
+        return cls.from_csv(filename)
+
+    @classmethod
+    def from_csv(cls, filename: str) -> 'Boedeltermen':
+        """Reads boedeltermen.csv (lemma, type, normalised wordform, variant wordform, uri), quoting is supported"""
+        entries: Dict[Tuple[str, str], List[Tuple[str, str]]] = {}
+        with open(filename, 'r', encoding='utf-8', newline='') as f:
+            for fields in csv.reader(f):
+                if len(fields) <= BOEDELTERMEN_URI or tuple(fields[:5]) == BOEDELTERMEN_HEADER:
+                    continue
+                if fields[BOEDELTERMEN_URI] and fields[BOEDELTERMEN_LEMMA]:
+                    key = (sys.intern(fields[BOEDELTERMEN_NORMWORDFORM]), sys.intern(fields[BOEDELTERMEN_TYPE]))
+                    value = (sys.intern(fields[BOEDELTERMEN_URI]), sys.intern(fields[BOEDELTERMEN_LEMMA]))
+                    values = entries.setdefault(key, [])
+                    if value not in values:
+                        values.append(value)
+        return cls({key: tuple(values) for key, values in entries.items()})
+
+    @classmethod
+    def load(cls, filename: str) -> 'Boedeltermen':
+        """Loads a prebuilt binary index (see save())"""
+        with open(filename, 'rb') as f:
+            if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+                raise ValueError(f"{filename} is not a prebuilt boedeltermen index")
+            return cls(pickle.load(f))
+
+    def save(self, filename: str):
+        """Writes the index to a binary file that loads considerably faster than the CSV file"""
+        with atomic_open(filename, 'wb') as f:
+            f.write(BINARY_MAGIC)
+            pickle.dump(dict(self.index), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def get(self, variant: str, category: str) -> Tuple[Tuple[str, str], ...]:
+        """Returns the (uri, lemma) pairs for a wordform and type, an empty tuple if there are none"""
+        return self.index.get((variant, category), ())
+
+    def __contains__(self, key: Tuple[str, str]) -> bool:
+        return key in self.index
+
+    def __getitem__(self, key: Tuple[str, str]) -> Tuple[Tuple[str, str], ...]:
+        return self.index[key]
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getstate__(self):
+        return dict(self.index)
+
+    def __setstate__(self, state):
+        self.index = MappingProxyType(state)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Prebuild a binary boedeltermen index from boedeltermen CSV, which can be specified for "
+                    "'boedeltermen' in the NER configuration instead of the CSV file",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("csvfile", help="Boedeltermen CSV file (e.g. boedeltermen.mappedcategories.csv)", type=str)
+    parser.add_argument("outputfile", help="Binary index to write", type=str)
+    args = parser.parse_args()
+    boedeltermen = Boedeltermen.from_csv(args.csvfile)
+    boedeltermen.save(args.outputfile)
+    print(f"Wrote {len(boedeltermen)} boedeltermen to {args.outputfile}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
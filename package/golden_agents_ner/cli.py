@@ -1,10 +1,32 @@
 #!/usr/bin/env python3
 import argparse
+import io
 import json
+import multiprocessing
 import os.path
 import sys
+import time
+from collections import deque, Counter
+from typing import Iterable, Iterator, List, Optional, TextIO, Tuple, Union
 
+from golden_agents_ner.lineindex import LineIndex, lineindex_filename
+from golden_agents_ner.manifest import Manifest, manifest_filename
 from golden_agents_ner.ner import NER, NoArchiveIDError
+from golden_agents_ner.profiling import ProfileReport
+from golden_agents_ner.scancache import CachedScan, is_scancache, iter_cached_scans
+from golden_agents_ner.sharding import in_shard, parse_shard
+from golden_agents_ner.writer import COMPRESSION_SUFFIXES, OutputWriter, check_compression, write_outputs
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Environment variable that enables profiling (set to the TSV file to write)
+PROFILE_ENV = "GOLDEN_AGENTS_NER_PROFILE"
+
+# State shared with forked worker processes (ner, out_root, args); set by parsefiles_parallel() prior to forking
+_worker_state = None
 
 
 def main():
@@ -18,24 +40,123 @@ def main():
     parser.add_argument('--stdout', '-o', help="Output JSON to standard output", action='store_true', required=False)
     parser.add_argument('--rawout', '-r', help="Output raw results from analiticcl to standard output (as JSON)",
                         action='store_true', required=False)
+    parser.add_argument('--format', '-f', type=str, choices=('json', 'jsonl'),
+                        help="Output format: a JSON array per file (json), or JSON Lines (jsonl) with one annotation "
+                             "(or raw result) per line, written as soon as it is produced",
+                        action='store', default='json')
+    parser.add_argument('--workers', '-j', type=int,
+                        help="Number of worker processes to distribute the PageXML files over. The model is loaded "
+                             "only once and shared with the workers by forking (POSIX only)",
+                        action='store', default=1)
+    parser.add_argument('--threads', '-t', type=int,
+                        help="Number of threads to match the lines of a scan with (per worker process)",
+                        action='store', default=1)
+    parser.add_argument('--compress', type=str, choices=tuple(COMPRESSION_SUFFIXES),
+                        help="Compress the output files (adds .gz or .zst to the filenames); zstd requires the "
+                             "zstandard package",
+                        action='store', required=False)
+    parser.add_argument('--write-queue', type=int,
+                        help="Number of scans whose output may wait to be written by a background thread while the "
+                             "next scans are tagged (with a single worker process); 0 writes the output before "
+                             "tagging the next scan",
+                        action='store', default=8)
+    parser.add_argument('--fsync', help="Flush every output file to disk before recording it in the manifest",
+                        action='store_true', required=False)
+    parser.add_argument('--matchcache-size', type=int,
+                        help="Maximum number of lines for which the matching results are cached in memory "
+                             "(identical lines recur often in the inventories); 0 disables the cache",
+                        action='store', default=10000)
+    parser.add_argument('--matchcache-file', type=str,
+                        help="SQLite database in which matching results are persisted across runs (requires "
+                             "--matchcache-size > 0)",
+                        action='store', required=False)
+    parser.add_argument('--manifest', type=str,
+                        help="Manifest file recording the completed input files (when writing output files). Defaults "
+                             "to a hidden file in the destination directory",
+                        action='store', required=False)
+    parser.add_argument('--resume', help="Skip input files that the manifest lists as completed, with the same "
+                                         "configuration and resources, and that are unchanged since",
+                        action='store_true', required=False)
+    parser.add_argument('--shard', type=str,
+                        help="Process only shard K of N (K/N, e.g. 1/4) of the input files. Files are assigned to "
+                             "shards by a hash of their archive directory and filename, so the assignment is "
+                             "deterministic and stable as the index grows. Each shard keeps its own manifest; use "
+                             "golden-agents-ner-merge to combine them",
+                        action='store', required=False)
+    parser.add_argument('--line-index', help="Record the processed lines in a line index (SQLite), which allows "
+                                             "re-tagging only the affected lines when resources change (see "
+                                             "golden-agents-ner-retag)",
+                        action='store_true', required=False)
+    parser.add_argument('--line-index-file', type=str,
+                        help="File for the line index (requires --line-index). Defaults to a hidden file in the "
+                             "destination directory",
+                        action='store', required=False)
+    parser.add_argument('--profile', type=str,
+                        help="Profile the pipeline: time each stage and write counters and timings per input file to "
+                             "this TSV file, a summary is printed at the end. Can also be enabled by setting the "
+                             f"{PROFILE_ENV} environment variable to the TSV file",
+                        action='store', default=os.environ.get(PROFILE_ENV))
     parser.add_argument("pagexmlfiles",
                         nargs="*",
-                        help="The PageXML file(s) to extract NER annotations from",
+                        help="The PageXML file(s) to extract NER annotations from. Scan cache files (*.scans.jsonl, "
+                             "see golden-agents-ner-extract) can be passed instead to skip parsing the PageXML",
                         type=str)
     args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.threads < 1:
+        parser.error("--threads must be at least 1")
+    if args.write_queue < 0:
+        parser.error("--write-queue must not be negative")
+    try:
+        check_compression(args.compress)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.line_index_file and not args.line_index:
+        parser.error("--line-index-file requires --line-index")
+    if args.shard:
+        try:
+            args.shard = parse_shard(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+    if next(iter_inputfiles(*args.pagexmlfiles), None) is None:
+        parser.error("No input: specify PageXML files, scan cache files or lists of them")
 
-    ner = NER(args.config)
+    ner = NER(args.config, matchcache_size=args.matchcache_size, matchcache_file=args.matchcache_file,
+              threads=args.threads, profile=bool(args.profile))
 
     if args.pagexmlfiles:
         out_root = "."
         if args.destinationdir:
             os.makedirs(args.destinationdir, exist_ok=True)
             out_root = args.destinationdir
-        parsefiles(ner, out_root, args, *[x for x in args.pagexmlfiles])
-
+        if args.stdout or args.rawout:
+            manifest = None
+        else:
+            # keep track of completed inputs so interrupted runs can be resumed
+            manifest = Manifest(args.manifest or manifest_filename(out_root, args.infix, args.shard),
+                                config_hash=output_config_hash(ner, args))
+        if args.line_index and manifest is not None:
+            lineindex = LineIndex(args.line_index_file or lineindex_filename(out_root, args.infix, args.shard))
+            ner.record_lines()
+        else:
+            lineindex = None
+        report = ProfileReport(args.profile) if args.profile else None
+        start = time.perf_counter()
+        parsefiles(ner, out_root, args, *[x for x in args.pagexmlfiles], manifest=manifest, report=report,
+                   lineindex=lineindex)
+        if manifest is not None:
+            manifest.close()
+        if lineindex is not None:
+            lineindex.close()
+        if report is not None:
+            report.close()
+        ner.print_statistics(elapsed=time.perf_counter() - start)
 
 
-def parsefiles(ner, out_root: str, args, *files):
+def iter_inputfiles(*files) -> Iterator[str]:
+    """Yields all PageXML files to process, in processing order. Files ending in .lst or .index are not PageXML
+    files but list other files (one per line), these are expanded recursively."""
     for pagexmlfile in sorted(files):
         if pagexmlfile.endswith(".lst") or pagexmlfile.endswith(".index"):
             # not a pagexml file but a file referring to page xml files:
@@ -43,34 +164,232 @@ def parsefiles(ner, out_root: str, args, *files):
             with open(pagexmlfile, 'r', encoding='utf-8') as f:
                 for line in f:
                     if line.strip(): morefiles.append(line.strip())
-            parsefiles(ner, out_root, args, *morefiles)
+            yield from iter_inputfiles(*morefiles)
+        else:
+            yield pagexmlfile
+
+
+def iter_inputs(*files) -> Iterator[Union[str, CachedScan]]:
+    """Yields the inputs to process: PageXML files, and the scans from any scan cache files"""
+    for inputfile in iter_inputfiles(*files):
+        if is_scancache(inputfile):
+            yield from iter_cached_scans(inputfile)
         else:
-            try:
-                (annotations, plain_text, raw_results) = ner.process_pagexml(pagexmlfile)
-            except NoArchiveIDError:
-                print(f"ERROR: Unable to process {pagexmlfile}, does not have an archive identifier! Skipping...", file=sys.stderr)
-                continue
-            basename = os.path.splitext(os.path.basename(pagexmlfile))[0]
-
-            if args.rawout:
-                json.dump(obj=raw_results, fp=sys.stdout, indent=4, ensure_ascii=False)
-            elif args.stdout:
-                json.dump(obj=annotations, fp=sys.stdout, indent=4, ensure_ascii=False)
-            else:
-                if args.infix:
-                    json_file = os.path.join(out_root, f"{basename}.{args.infix}.json")
-                    text_file = os.path.join(out_root, f"{basename}.{args.infix}.txt")
-                else:
-                    json_file = os.path.join(out_root, f"{basename}.json")
-                    text_file = os.path.join(out_root, f"{basename}.txt")
-
-                print(f'writing to {json_file}', file=sys.stderr)
-                with open(json_file, 'w', encoding='utf8') as f:
-                    json.dump(obj=annotations, fp=f, indent=4, ensure_ascii=False)
-
-                print(f'writing to {text_file}', file=sys.stderr)
-                with open(text_file, 'w', encoding='utf8') as f:
-                    f.write(plain_text)
+            yield inputfile
+
+
+def input_name(pagexmlfile: Union[str, CachedScan]) -> str:
+    """The PageXML file an input stems from"""
+    return pagexmlfile.filename if isinstance(pagexmlfile, CachedScan) else pagexmlfile
+
+
+def input_source(pagexmlfile: Union[str, CachedScan]) -> str:
+    """The file an input is read from (whose state the manifest records)"""
+    return pagexmlfile.source if isinstance(pagexmlfile, CachedScan) else pagexmlfile
+
+
+def parsefiles(ner, out_root: str, args, *files, manifest: Optional[Manifest] = None,
+               report: Optional[ProfileReport] = None, lineindex: Optional[LineIndex] = None):
+    pagexmlfiles = iter_inputs(*files)
+    if getattr(args, 'shard', None):
+        # cached scans are assigned to the same shard as the PageXML file they stem from
+        pagexmlfiles = (x for x in pagexmlfiles if in_shard(input_name(x), *args.shard))
+    if manifest is not None and getattr(args, 'resume', False):
+        pagexmlfiles = skip_done(ner, pagexmlfiles, manifest)
+    if getattr(args, 'workers', 1) > 1:
+        parsefiles_parallel(ner, out_root, args, pagexmlfiles, manifest, report, lineindex)
+    else:
+        parsefiles_serial(ner, out_root, args, pagexmlfiles, manifest, report, lineindex)
+
+
+def output_config_hash(ner, args) -> str:
+    """What the manifest records as the configuration the outputs were made with"""
+    config_hash = f"{ner.fingerprint()}:{args.format}"
+    if getattr(args, 'compress', None):
+        config_hash += f":{args.compress}"
+    return config_hash
+
+
+def parsefiles_serial(ner, out_root: str, args, pagexmlfiles: Iterable[Union[str, CachedScan]], manifest: Optional[Manifest] = None,
+                      report: Optional[ProfileReport] = None, lineindex: Optional[LineIndex] = None):
+    """Processes the files one by one; output files are written by a background thread while the next file is tagged,
+    a file is recorded (in the manifest, report and line index) once its output files are written"""
+    # time spent by the writer, added to the statistics only when everything is written (otherwise it would end up in
+    # the statistics of the file being tagged meanwhile)
+    written = Counter() if ner.profile else None
+    with OutputWriter(getattr(args, 'write_queue', 8), getattr(args, 'fsync', False)) as writer:
+        for pagexmlfile in pagexmlfiles:
+            before = ner.statistics.copy()
+            outputfiles = parsefile(ner, out_root, args, pagexmlfile, sys.stdout, writer)
+            writer.when_written(_record_written, written, manifest, report, pagexmlfile, outputfiles,
+                                ner.statistics - before, lineindex, ner.pop_line_records())
+    if written is not None:
+        ner.statistics.update(written)
+
+
+def _record_written(write_time: float, written: Optional[Counter], manifest: Optional[Manifest],
+                    report: Optional[ProfileReport], pagexmlfile: Union[str, CachedScan],
+                    outputfiles: Optional[List[str]], statistics: Counter, lineindex: Optional[LineIndex] = None,
+                    line_records: Optional[List[dict]] = None):
+    """Records a file once the writer has written its output files; when profiling, the time that took is added to
+    the serialization stage of the file and to written"""
+    if written is not None and outputfiles:
+        for counter in (statistics, written):
+            counter["time_serialization"] += write_time
+            counter["calls_serialization"] += 1
+    _record(manifest, report, pagexmlfile, outputfiles, statistics, lineindex, line_records)
+
+
+def skip_done(ner, pagexmlfiles: Iterable[Union[str, CachedScan]], manifest: Manifest) \
+        -> Iterator[Union[str, CachedScan]]:
+    """Filters out the files the manifest lists as done"""
+    for pagexmlfile in pagexmlfiles:
+        if manifest.is_done(input_name(pagexmlfile), source=input_source(pagexmlfile)):
+            ner.statistics['resume_skipped'] += 1
+        else:
+            yield pagexmlfile
+
+
+def parsefiles_parallel(ner, out_root: str, args, pagexmlfiles: Iterable[Union[str, CachedScan]], manifest: Optional[Manifest] = None,
+                        report: Optional[ProfileReport] = None, lineindex: Optional[LineIndex] = None):
+    """Distributes the files over a pool of worker processes. The workers are forked after the model is built so
+    they all share it. Output to standard output is written by the parent process, in the same order as a serial
+    run would. At most two files per worker are in flight at any time, which keeps memory consumption bounded."""
+    global _worker_state
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        print("WARNING: Multiple workers require the 'fork' start method which is not available on this platform, "
+              "falling back to a single process", file=sys.stderr)
+        parsefiles_serial(ner, out_root, args, pagexmlfiles, manifest, report, lineindex)
+        return
+    _worker_state = (ner, out_root, args)
+    max_pending = args.workers * 2
+    pending = deque()
+    with multiprocessing.get_context('fork').Pool(args.workers) as pool:
+        for pagexmlfile in pagexmlfiles:
+            pending.append((pagexmlfile, pool.apply_async(_parsefile_in_worker, (pagexmlfile,))))
+            if len(pending) >= max_pending:
+                _collect_from_worker(ner, manifest, report, lineindex, *pending.popleft())
+        while pending:
+            _collect_from_worker(ner, manifest, report, lineindex, *pending.popleft())
+    _worker_state = None
+
+
+def _collect_from_worker(ner, manifest: Optional[Manifest], report: Optional[ProfileReport],
+                         lineindex: Optional[LineIndex], pagexmlfile: Union[str, CachedScan], result):
+    output, outputfiles, statistics, line_records = result.get()
+    sys.stdout.write(output)
+    ner.statistics.update(statistics)
+    _record(manifest, report, pagexmlfile, outputfiles, statistics, lineindex, line_records)
+
+
+def _record(manifest: Optional[Manifest], report: Optional[ProfileReport], pagexmlfile: Union[str, CachedScan],
+            outputfiles: Optional[List[str]], statistics: Counter, lineindex: Optional[LineIndex] = None,
+            line_records: Optional[List[dict]] = None):
+    """Records a processed file in the manifest, the profile report and the line index"""
+    if outputfiles is None:
+        return
+    if lineindex is not None and line_records:
+        lineindex.add_scan(input_name(pagexmlfile), outputfiles, line_records[-1])
+    if manifest is not None:
+        manifest.add(input_name(pagexmlfile), outputfiles, source=input_source(pagexmlfile),
+                     statistics=dict(statistics))
+    if report is not None:
+        report.add(input_name(pagexmlfile), statistics)
+
+
+def _parsefile_in_worker(pagexmlfile: Union[str, CachedScan]) -> Tuple[str, Optional[List[str]], Counter, List[dict]]:
+    """Runs in a worker process, returns whatever should be written to standard output, the output files, the
+    statistics and the line records"""
+    ner, out_root, args = _worker_state
+    stdout = io.StringIO()
+    outputfiles = parsefile(ner, out_root, args, pagexmlfile, stdout)
+    return stdout.getvalue(), outputfiles, ner.pop_statistics(), ner.pop_line_records()
+
+
+def parsefile(ner, out_root: str, args, pagexmlfile: Union[str, CachedScan], stdout: TextIO,
+              writer: Optional[OutputWriter] = None) -> Optional[List[str]]:
+    """Processes a single PageXML file (or cached scan) and writes the output, returns the output files written (empty
+    when writing to standard output) or None if the file was skipped. Output files are written atomically, by the
+    writer if given (in which case they may not be written yet on return)."""
+    if isinstance(pagexmlfile, CachedScan):
+        scan = pagexmlfile
+    else:
+        try:
+            scan = ner.read_pagexml(pagexmlfile)
+        except NoArchiveIDError:
+            print(f"ERROR: Unable to process {pagexmlfile}, does not have an archive identifier! Skipping...", file=sys.stderr)
+            return None
+    basename = os.path.splitext(os.path.basename(input_name(pagexmlfile)))[0]
+
+    if getattr(args, 'format', 'json') == 'jsonl':
+        return write_jsonl(ner, scan, out_root, args, basename, stdout, writer)
+
+    (annotations, plain_text, raw_results) = ner.create_web_annotations(scan)
+    if args.rawout:
+        with ner.stage("serialization"):
+            json.dump(obj=raw_results, fp=stdout, indent=4, ensure_ascii=False)
+    elif args.stdout:
+        with ner.stage("serialization"):
+            json.dump(obj=annotations, fp=stdout, indent=4, ensure_ascii=False)
+    else:
+        json_file, text_file = output_files(out_root, args, basename, "json")
+        submit_outputs(ner, args, writer, [
+            (json_file, lambda f: json.dump(obj=annotations, fp=f, indent=4, ensure_ascii=False)),
+            (text_file, lambda f: f.write(plain_text)),
+        ])
+        return [json_file, text_file]
+    return []
+
+
+def submit_outputs(ner, args, writer: Optional[OutputWriter], writes):
+    """Writes the output files, by the writer if given. The writer times the writing itself, on its own thread; the
+    time is added to the serialization stage once the files are written (see _record_written())."""
+    if writer is not None:
+        writer.submit(writes)
+    else:
+        with ner.stage("serialization"):
+            write_outputs(writes, getattr(args, 'fsync', False))
+
+
+def write_jsonl(ner, scan, out_root: str, args, basename: str, stdout: TextIO,
+                writer: Optional[OutputWriter] = None) -> List[str]:
+    """Writes the annotations (or raw results) as JSON Lines, one object per line; to standard output as soon as a
+    text line is tagged"""
+    if args.rawout or args.stdout:
+        for _, ner_results, annotations in ner.iter_web_annotations(scan):
+            with ner.stage("serialization"):
+                for obj in (ner_results if args.rawout else annotations):
+                    stdout.write(dumps_jsonl(obj))
+    else:
+        json_file, text_file = output_files(out_root, args, basename, "jsonl")
+        texts, annotations = [], []
+        for text, _, line_annotations in ner.iter_web_annotations(scan):
+            texts.append(text)
+            annotations += line_annotations
+        submit_outputs(ner, args, writer, [
+            (json_file, lambda f: f.writelines(dumps_jsonl(annotation) for annotation in annotations)),
+            (text_file, lambda f: f.writelines(f"{text}\n" for text in texts)),
+        ])
+        return [json_file, text_file]
+    return []
+
+
+def dumps_jsonl(obj) -> str:
+    """Serialises an object to a single line of JSON (including the trailing newline)"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE).decode('utf-8')
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')) + "\n"
+
+
+def output_files(out_root: str, args, basename: str, extension: str) -> Tuple[str, str]:
+    """Returns the paths of the annotation file and the plain text file for the given basename"""
+    suffix = COMPRESSION_SUFFIXES[args.compress] if getattr(args, 'compress', None) else ""
+    if args.infix:
+        return (os.path.join(out_root, f"{basename}.{args.infix}.{extension}{suffix}"),
+                os.path.join(out_root, f"{basename}.{args.infix}.txt{suffix}"))
+    else:
+        return (os.path.join(out_root, f"{basename}.{extension}{suffix}"),
+                os.path.join(out_root, f"{basename}.txt{suffix}"))
 
 
 if __name__ == '__main__':
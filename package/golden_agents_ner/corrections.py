@@ -1,31 +1,58 @@
-from nltk import ngrams
+from typing import Dict, List
 
 
 class Corrector:
+    """Applies HTR corrections: maps words or sequences of words (n-grams) to their corrected form.
+
+    Corrections are applied in stages of increasing n-gram length, each stage operating on the output of the
+    previous one (so a bigram correction can apply to words produced by a unigram correction). Each stage is a
+    single left-to-right pass over the tokens using a token-level trie, no candidate n-grams are constructed."""
 
     def __init__(self, corrections: dict):
         self.corrections = corrections
-        self.max_ngram = max(k.count(' ') for k in corrections) + 1
+        self.max_ngram = max((k.count(' ') for k in corrections), default=0) + 1
+        # one trie per n-gram length (only for lengths that actually occur), maps token by token to the
+        # replacement tokens, which are stored under the None key
+        tries: Dict[int, dict] = {}
+        for orig, replacement in corrections.items():
+            tokens = orig.split(' ')
+            node = tries.setdefault(len(tokens), {})
+            for token in tokens:
+                node = node.setdefault(token, {})
+            node[None] = replacement.split(' ')
+        self.stages = sorted(tries.items())
 
     def correct(self, raw_str: str) -> str:
-        corrected = raw_str
-        for n in range(1, self.max_ngram + 1):
-            words = corrected.split(' ')  # TODO: check the words have not already been corrected?
-            ngram_corrections = {}
-            for i, t in enumerate(ngrams(words, n)):
-                orig = " ".join(t)
-                if orig in self.corrections:
-                    ngram_corrections[i] = self.corrections[orig]
-            if ngram_corrections:
-                corrected_terms = []
-                i = 0
-                while i < len(words):
-                    if i in ngram_corrections:
-                        corrected_terms.append(ngram_corrections[i])
-                        i += n
-                    else:
-                        corrected_terms.append(words[i])
-                        i += 1
-                corrected = ' '.join(corrected_terms)
+        words = raw_str.split(' ')
+        changed = False
+        for n, trie in self.stages:
+            corrected_words = self.correct_stage(words, n, trie)
+            if corrected_words is not None:
+                words = corrected_words
+                changed = True
+        return ' '.join(words) if changed else raw_str
 
-        return corrected
+    @staticmethod
+    def correct_stage(words: List[str], n: int, trie: dict):
+        """Replaces all n-grams in the trie, scanning left to right. Returns None if nothing was replaced."""
+        corrected_words = None
+        i = 0
+        last = len(words) - n
+        while i <= last:
+            node = trie.get(words[i])
+            j = i + 1
+            while node is not None and j < i + n:
+                node = node.get(words[j])
+                j += 1
+            if node is not None:
+                if corrected_words is None:
+                    corrected_words = words[:i]
+                corrected_words += node[None]
+                i += n
+            else:
+                if corrected_words is not None:
+                    corrected_words.append(words[i])
+                i += 1
+        if corrected_words is not None:
+            corrected_words += words[i:]
+        return corrected_words
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import os.path
+import re
+import sqlite3
+import sys
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from golden_agents_ner.manifest import MANIFEST_NAME
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+# Version of the database layout, indices of another version have to be rebuilt
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scans (
+    id INTEGER PRIMARY KEY,
+    input TEXT UNIQUE NOT NULL,
+    scan_id TEXT,
+    pid TEXT,
+    text_pid TEXT,
+    outputs TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS lines (
+    id INTEGER PRIMARY KEY,
+    scan INTEGER NOT NULL REFERENCES scans(id),
+    line_no INTEGER NOT NULL,
+    line_id TEXT,
+    raw_text TEXT NOT NULL,
+    text TEXT NOT NULL,
+    x INTEGER, y INTEGER, w INTEGER, h INTEGER,
+    line_offset INTEGER NOT NULL,
+    annotations TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS lines_scan ON lines(scan, line_no);
+CREATE TABLE IF NOT EXISTS tokens (
+    token TEXT NOT NULL,
+    line INTEGER NOT NULL REFERENCES lines(id),
+    begin INTEGER NOT NULL,
+    end INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tokens_token ON tokens(token);
+CREATE INDEX IF NOT EXISTS tokens_line ON tokens(line);
+CREATE TABLE IF NOT EXISTS sources (
+    source TEXT NOT NULL,
+    line INTEGER NOT NULL REFERENCES lines(id)
+);
+CREATE INDEX IF NOT EXISTS sources_source ON sources(source);
+CREATE INDEX IF NOT EXISTS sources_line ON sources(line);
+CREATE TABLE IF NOT EXISTS matches (
+    line INTEGER NOT NULL REFERENCES lines(id),
+    input TEXT NOT NULL,
+    variant TEXT NOT NULL,
+    normalized_variant TEXT NOT NULL,
+    score REAL NOT NULL,
+    begin INTEGER NOT NULL,
+    end INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS matches_variant ON matches(normalized_variant);
+CREATE INDEX IF NOT EXISTS matches_line ON matches(line);
+"""
+
+
+def normalize_tokens(text: str) -> Set[str]:
+    """The normalised (lowercased, without punctuation) tokens of a text"""
+    return {token.lower() for token in TOKEN_PATTERN.findall(text)}
+
+
+def tokenize(text: str) -> Iterator[Tuple[str, int, int]]:
+    """Yields the normalised tokens of a text with their (unicode character) begin and end offsets"""
+    for m in TOKEN_PATTERN.finditer(text):
+        yield m.group().lower(), m.start(), m.end()
+
+
+def lineindex_filename(out_root: str, infix: Optional[str] = None, shard: Optional[Tuple[int, int]] = None) -> str:
+    name = MANIFEST_NAME
+    if infix:
+        name += f".{infix}"
+    if shard:
+        name += f".shard{shard[0]}of{shard[1]}"
+    return os.path.join(out_root, f"{name}.lines.sqlite")
+
+
+class LineIndex:
+    """SQLite database recording, for each processed scan, its lines (with everything needed to annotate a line again
+    without the PageXML), the identifiers of the annotations made on each line, the resources (lexicons, variant
+    lists) the matches of each line came from, and inverted indices from normalised tokens and from best variants to
+    their occurrences in the lines.
+
+    Used to re-tag only the affected lines when resources change (see golden-agents-ner-retag) and to look up where
+    tokens or variants occur (see golden-agents-ner-query)."""
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        (version,) = self.connection.execute("PRAGMA user_version").fetchone()
+        (tables,) = self.connection.execute("SELECT count(*) FROM sqlite_master").fetchone()
+        if tables and version != SCHEMA_VERSION:
+            self.connection.close()
+            raise ValueError(f"Line index {filename} was created by another version, remove it and run again")
+        self.connection.executescript(SCHEMA)
+        self.connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def add_scan(self, inputfile: str, outputfiles: List[str], record: dict):
+        """Records a processed scan (replacing any earlier record of the same input file), record is a scan record
+        as returned by NER.pop_line_records()"""
+        inputfile = os.path.abspath(inputfile)
+        with self.connection:
+            self.remove_scan(inputfile)
+            cursor = self.connection.execute(
+                "INSERT INTO scans (input, scan_id, pid, text_pid, outputs) VALUES (?, ?, ?, ?, ?)",
+                (inputfile, record['id'], record['pid'], record['text_pid'],
+                 json.dumps([os.path.abspath(x) for x in outputfiles])))
+            scan = cursor.lastrowid
+            for line_no, line in enumerate(record['lines']):
+                cursor = self.connection.execute(
+                    "INSERT INTO lines (scan, line_no, line_id, raw_text, text, x, y, w, h, line_offset, annotations) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (scan, line_no, line['id'], line['raw_text'], line['text'], *line['coords'], line['offset'],
+                     json.dumps(line['annotations'])))
+                line_rowid = cursor.lastrowid
+                self.connection.executemany("INSERT INTO tokens (token, line, begin, end) VALUES (?, ?, ?, ?)",
+                                            ((token, line_rowid, begin, end)
+                                             for token, begin, end in tokenize(line['text'])))
+                self._insert_results(line_rowid, line)
+
+    def _insert_results(self, line: int, record: dict):
+        self.connection.executemany("INSERT INTO sources (source, line) VALUES (?, ?)",
+                                    ((os.path.realpath(source), line) for source in record['sources']))
+        self.connection.executemany(
+            "INSERT INTO matches (line, input, variant, normalized_variant, score, begin, end) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            ((line, text, variant, variant.lower(), score, begin, end)
+             for text, variant, score, begin, end in record['matches']))
+
+    def remove_scan(self, inputfile: str):
+        row = self.connection.execute("SELECT id FROM scans WHERE input = ?", (inputfile,)).fetchone()
+        if row is None:
+            return
+        lines = "SELECT id FROM lines WHERE scan = ?"
+        for table in ("tokens", "sources", "matches"):
+            self.connection.execute(f"DELETE FROM {table} WHERE line IN ({lines})", row)
+        self.connection.execute("DELETE FROM lines WHERE scan = ?", row)
+        self.connection.execute("DELETE FROM scans WHERE id = ?", row)
+
+    def tokens(self) -> Iterable[str]:
+        """Yields all distinct tokens"""
+        for (token,) in self.connection.execute("SELECT DISTINCT token FROM tokens"):
+            yield token
+
+    def sources(self) -> Iterable[str]:
+        """Yields all distinct resources matches came from"""
+        for (source,) in self.connection.execute("SELECT DISTINCT source FROM sources"):
+            yield source
+
+    def lines_with_tokens(self, tokens: Iterable[str]) -> Set[int]:
+        """Returns the (row) identifiers of the lines containing any of the tokens"""
+        return self._select_lines("SELECT line FROM tokens WHERE token IN ({})", tokens)
+
+    def lines_with_sources(self, sources: Iterable[str]) -> Set[int]:
+        """Returns the (row) identifiers of the lines with matches from any of the resources"""
+        return self._select_lines("SELECT line FROM sources WHERE source IN ({})", sources)
+
+    def _select_lines(self, query: str, values: Iterable[str], chunksize: int = 500) -> Set[int]:
+        values = list(values)
+        lines = set()
+        for i in range(0, len(values), chunksize):
+            chunk = values[i:i + chunksize]
+            lines.update(line for (line,) in
+                         self.connection.execute(query.format(",".join("?" * len(chunk))), chunk))
+        return lines
+
+    def find_tokens(self, term: str, prefix: bool = False) -> List[sqlite3.Row]:
+        """Returns the occurrences of a token (or of all tokens starting with it): the scan's pid and text pid, the
+        line's identifier, text and offset in the scan's text, and the token with its offsets in the line"""
+        return self._find("tokens", "token", term.lower(), prefix, "t.token AS found")
+
+    def find_variants(self, term: str, prefix: bool = False, min_score: float = 0.0) -> List[sqlite3.Row]:
+        """Returns the matches whose best variant is the term (case-insensitive) or starts with it, like
+        find_tokens(), with the matched text (input), the variant and its score"""
+        return self._find("matches", "normalized_variant", term.lower(), prefix,
+                          "t.variant AS found, t.input, t.score", "AND t.score >= ?", (min_score,))
+
+    def _find(self, table: str, column: str, term: str, prefix: bool, fields: str, condition: str = "",
+              parameters: tuple = ()) -> List[sqlite3.Row]:
+        if prefix:
+            # a range rather than LIKE, so the index is used
+            where, values = f"t.{column} >= ? AND t.{column} < ?", (term, term + "\U0010ffff")
+        else:
+            where, values = f"t.{column} = ?", (term,)
+        cursor = self.connection.execute(
+            f"SELECT s.pid, s.text_pid, l.line_id, l.text, l.line_offset, t.begin, t.end, {fields} "
+            f"FROM {table} t JOIN lines l ON t.line = l.id JOIN scans s ON l.scan = s.id "
+            f"WHERE {where} {condition} ORDER BY s.input, l.line_no, t.begin", values + parameters)
+        cursor.row_factory = sqlite3.Row
+        return cursor.fetchall()
+
+    def scans_of_lines(self, lines: Iterable[int]) -> Dict[int, Set[int]]:
+        """Groups lines by scan, returns a mapping of scan (row) identifiers to line (row) identifiers"""
+        scans = {}
+        for line in lines:
+            (scan,) = self.connection.execute("SELECT scan FROM lines WHERE id = ?", (line,)).fetchone()
+            scans.setdefault(scan, set()).add(line)
+        return scans
+
+    def scan(self, scan: int) -> sqlite3.Row:
+        cursor = self.connection.execute("SELECT * FROM scans WHERE id = ?", (scan,))
+        cursor.row_factory = sqlite3.Row
+        return cursor.fetchone()
+
+    def scan_lines(self, scan: int) -> List[sqlite3.Row]:
+        """Returns all lines of a scan, in order"""
+        cursor = self.connection.execute("SELECT * FROM lines WHERE scan = ? ORDER BY line_no", (scan,))
+        cursor.row_factory = sqlite3.Row
+        return cursor.fetchall()
+
+    def inputs(self) -> List[str]:
+        return [inputfile for (inputfile,) in self.connection.execute("SELECT input FROM scans")]
+
+    def update_line(self, line: int, record: dict):
+        """Records the new annotations, sources and matches of a re-tagged line, record is a line record as made by
+        NER.line_record()"""
+        self.connection.execute("UPDATE lines SET annotations = ? WHERE id = ?",
+                                (json.dumps(record['annotations']), line))
+        self.connection.execute("DELETE FROM sources WHERE line = ?", (line,))
+        self.connection.execute("DELETE FROM matches WHERE line = ?", (line,))
+        self._insert_results(line, record)
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Look up where tokens or best variants occur in a corpus processed by golden-agents-ner "
+                    "--line-index. Prints a tab separated line per occurrence: scan pid, line id, begin and end offset "
+                    "in the line, begin and end offset in the text of the scan, the token or variant found (for "
+                    "variants also the matched text and the score) and the text of the line.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--index', '-i', type=str, action='append', required=True,
+                        help="Line index to search (may be specified multiple times, e.g. for shards)")
+    parser.add_argument('--variant', help="Search the best variants of the matches rather than the tokens of the text",
+                        action='store_true', required=False)
+    parser.add_argument('--prefix', '-p', help="Find everything starting with the search terms",
+                        action='store_true', required=False)
+    parser.add_argument('--min-score', type=float, help="Minimum score of the variants to find (with --variant)",
+                        action='store', default=0.0)
+    parser.add_argument('--scans', '-s', help="Only print the scans (pids) with occurrences, and how many",
+                        action='store_true', required=False)
+    parser.add_argument("terms", nargs="+", type=str, help="The tokens or variants to search for")
+    args = parser.parse_args()
+
+    total = 0
+    for indexfile in args.index:
+        if not os.path.exists(indexfile):
+            parser.error(f"No such line index: {indexfile}")
+        try:
+            lineindex = LineIndex(indexfile)
+        except ValueError as e:
+            parser.error(str(e))
+        for term in args.terms:
+            if args.variant:
+                rows = lineindex.find_variants(term, args.prefix, args.min_score)
+            else:
+                rows = lineindex.find_tokens(term, args.prefix)
+            total += len(rows)
+            if args.scans:
+                counts: Dict[str, int] = {}
+                for row in rows:
+                    counts[row['pid']] = counts.get(row['pid'], 0) + 1
+                for pid, count in counts.items():
+                    print(f"{pid}\t{count}")
+                continue
+            for row in rows:
+                fields = [row['pid'], row['line_id'], row['begin'], row['end'], row['line_offset'] + row['begin'],
+                          row['line_offset'] + row['end'], row['found']]
+                if args.variant:
+                    fields += [row['input'], row['score']]
+                print("\t".join(str(field) for field in fields + [row['text']]))
+        lineindex.close()
+    print(f"{total} occurrences", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
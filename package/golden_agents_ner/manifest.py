@@ -0,0 +1,137 @@
+import json
+import os
+import os.path
+import sys
+import tempfile
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+MANIFEST_NAME = ".golden-agents-ner"
+
+
+def _umask() -> int:
+    # the umask can only be read by setting it; done once, as it is process-wide and output is written from threads
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# The permissions of a newly created file (as open() would create it)
+FILE_MODE = 0o666 & ~_umask()
+
+
+@contextmanager
+def atomic_open(filename: str, mode: str = 'w', encoding: Optional[str] = 'utf8', fsync: bool = False):
+    """Opens a temporary file for writing that is renamed to the target filename only when it has been written
+    completely, so a crash never leaves a partially written file behind. If fsync is set, the file and the rename
+    are flushed to disk before returning."""
+    directory = os.path.dirname(filename) or "."
+    fd, tmpfile = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(filename)}.", suffix=".tmp")
+    try:
+        # mkstemp creates the file readable by its owner only, give it the permissions open() would have
+        os.fchmod(fd, FILE_MODE)
+        with os.fdopen(fd, mode, encoding=None if 'b' in mode else encoding) as f:
+            yield f
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmpfile, filename)
+    except BaseException:
+        os.unlink(tmpfile)
+        raise
+    if fsync:
+        dirfd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+
+
+def manifest_filename(out_root: str, infix: Optional[str] = None, shard: Optional[Tuple[int, int]] = None) -> str:
+    name = MANIFEST_NAME
+    if infix:
+        name += f".{infix}"
+    if shard:
+        name += f".shard{shard[0]}of{shard[1]}"
+    return os.path.join(out_root, f"{name}.manifest.jsonl")
+
+
+class Manifest:
+    """Records which input files have been processed completely, for which configuration and into which output
+    files. Used to resume interrupted batch runs.
+
+    The manifest is a JSON Lines file with one record per input file. Records are appended as inputs are completed;
+    when the manifest is opened it is compacted (later records supersede earlier ones) and rewritten atomically.
+    An incomplete last line (from a crash) is ignored."""
+
+    def __init__(self, filename: str, config_hash: str):
+        self.filename = filename
+        self.config_hash = config_hash
+        self.entries: Dict[str, dict] = {}
+        if os.path.exists(filename):
+            self.entries = self.read(filename)
+            with atomic_open(filename) as f:
+                for entry in self.entries.values():
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._file = open(filename, 'a', encoding='utf8')
+
+    @staticmethod
+    def read(filename: str) -> Dict[str, dict]:
+        entries = {}
+        with open(filename, 'r', encoding='utf8') as f:
+            for i, line in enumerate(f):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    print(f"WARNING: Ignoring malformed line {i + 1} in manifest {filename}", file=sys.stderr)
+                    continue
+                entries[entry['input']] = entry
+        return entries
+
+    @staticmethod
+    def input_state(inputfile: str) -> dict:
+        stat = os.stat(inputfile)
+        return {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+    def is_done(self, inputfile: str, source: Optional[str] = None) -> bool:
+        """Is the input file processed already, unchanged since and with the same configuration? If the input was
+        read from another file (source, e.g. a scan cache), that file must be unchanged instead."""
+        entry = self.entries.get(os.path.abspath(inputfile))
+        if entry is None or entry['config'] != self.config_hash:
+            return False
+        try:
+            state = self.input_state(source or inputfile)
+        except OSError:
+            return False
+        if entry['size'] != state['size'] or entry['mtime'] != state['mtime']:
+            return False
+        return all(os.path.exists(outputfile) for outputfile in entry['outputs'])
+
+    def add(self, inputfile: str, outputfiles: List[str], source: Optional[str] = None, **extra):
+        """Records that the input file (read from source, if given) has been processed completely"""
+        entry = {
+            "input": os.path.abspath(inputfile),
+            **self.input_state(source or inputfile),
+            "config": self.config_hash,
+            "outputs": [os.path.abspath(x) for x in outputfiles],
+            **extra,
+        }
+        self.entries[entry['input']] = entry
+        self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def update_config(self, inputfile: str, config_hash: str):
+        """Records that the outputs of an input file are (now) valid for another configuration, e.g. after re-tagging
+        them for changed resources"""
+        entry = self.entries.get(os.path.abspath(inputfile))
+        if entry is None:
+            return
+        entry['config'] = config_hash
+        self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __len__(self):
+        return len(self.entries)
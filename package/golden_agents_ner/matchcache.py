@@ -0,0 +1,70 @@
+import json
+import os
+import sqlite3
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+
+class MatchCache:
+    """A bounded LRU cache mapping (fingerprint, line text) to the results of analiticcl's find_all_matches().
+
+    The fingerprint identifies the search parameters (and, for persistent caches, the model), so results are never
+    shared between different configurations. If a filename is given, results are also stored in an SQLite
+    database that persists across runs and can be shared by multiple processes."""
+
+    def __init__(self, maxsize: int, filename: Optional[str] = None):
+        self.maxsize = maxsize
+        self.filename = filename
+        self.cache = OrderedDict()
+        self._db = None
+        self._db_pid = None
+
+    def _connection(self) -> sqlite3.Connection:
+        # connections can not be shared with forked child processes, each process opens its own
+        if self._db is None or self._db_pid != os.getpid():
+            self._db = sqlite3.connect(self.filename, timeout=60, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS matches (fingerprint TEXT NOT NULL, text TEXT NOT NULL, "
+                             "results TEXT NOT NULL, PRIMARY KEY (fingerprint, text))")
+            self._db_pid = os.getpid()
+        return self._db
+
+    def get(self, fingerprint: str, text: str) -> Optional[List[dict]]:
+        """Returns a copy of the cached results, or None if the text is not in the cache"""
+        key = (fingerprint, text)
+        results = self.cache.get(key)
+        if results is not None:
+            self.cache.move_to_end(key)
+        elif self.filename:
+            row = self._connection().execute("SELECT results FROM matches WHERE fingerprint = ? AND text = ?",
+                                             key).fetchone()
+            if row is None:
+                return None
+            results = json.loads(row[0])
+            self._add(key, results)
+        else:
+            return None
+        # the caller may add keys to the results, so return fresh dictionaries
+        return [dict(result) for result in results]
+
+    def put(self, fingerprint: str, text: str, results: List[dict]):
+        key = (fingerprint, text)
+        results = [dict(result) for result in results]
+        self._add(key, results)
+        if self.filename:
+            self._connection().execute("INSERT OR REPLACE INTO matches (fingerprint, text, results) VALUES (?, ?, ?)",
+                                       (fingerprint, text, json.dumps(results, ensure_ascii=False)))
+
+    def _add(self, key: Tuple[str, str], results: List[dict]):
+        self.cache[key] = results
+        if len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+
+    def __len__(self):
+        return len(self.cache)
+
+    def close(self):
+        if self._db is not None and self._db_pid == os.getpid():
+            self._db.close()
+        self._db = None
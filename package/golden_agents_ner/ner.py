@@ -1,20 +1,29 @@
 import csv
+import hashlib
 import json
 import os.path
 import sys
 import uuid
-from copy import deepcopy
 from datetime import datetime
-from typing import List, Dict, Any, Optional, Tuple, Generator
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple, Generator, Iterable, Union
+from collections import defaultdict, Counter
 
 from analiticcl import VariantModel, Weights, SearchParameters
+from golden_agents_ner.boedeltermen import Boedeltermen
 from golden_agents_ner.corrections import Corrector
-from pagexml.parser import PageXMLTextLine, parse_pagexml_file
+from golden_agents_ner.matchcache import MatchCache
+from golden_agents_ner.pagexmlreader import StreamedScan, read_pagexml_file
+from golden_agents_ner.profiling import StageTimer, NULL_TIMER, print_profile
+from golden_agents_ner.webannotation import ANNOTATION_CONTEXT, OBSERVATION_CONTEXT, GENERATOR, \
+    MOTIVATION_CLASSIFYING, MOTIVATION_CLASSIFYING_EDITING, image_target, text_target
+from pagexml.parser import PageXMLTextLine
 
 VARIANT_MATCHING_CONTEXT = "https://humanities.knaw.nl/ns/variant-matching.jsonld"
 HTR_CORRECTIONS = 'htr_corrections'
 ARCHIVE_IDENTIFIERS = 'archive_identifiers'
+# Bump this whenever the computation of resources_fingerprint() changes
+FINGERPRINT_VERSION = 2
 
 
 class NoResourceIDError(Exception):
@@ -54,28 +63,134 @@ def now():
     return datetime.today().isoformat()
 
 
+def file_digest(filepath: str, blocksize: int = 1 << 20) -> str:
+    """Computes a SHA-1 content hash of a file"""
+    h = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        while True:
+            block = f.read(blocksize)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+def resources_fingerprint(configfile: str, resources: Iterable[str]) -> str:
+    """Returns a fingerprint of a configuration file and the content of the resources it references"""
+    h = hashlib.sha1()
+    # a version prefix, so fingerprints recorded in existing manifests remain valid
+    h.update(f"v{FINGERPRINT_VERSION}\n".encode('utf-8'))
+    h.update(file_digest(configfile).encode('utf-8'))
+    for filepath in sorted(set(resources)):
+        h.update(f"\n{filepath}\t".encode('utf-8'))
+        if os.path.exists(filepath):
+            h.update(file_digest(filepath).encode('utf-8'))
+    return h.hexdigest()
+
+
+def params_fingerprint(params: SearchParameters) -> str:
+    """Returns a string uniquely identifying the search parameters"""
+    return hashlib.sha1(json.dumps(params.to_dict(), sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def read_archive_identifiers(filename: str) -> Dict[str, str]:
+    """Reads the archive identifiers file, maps archive titles (the directory names) to inventory numbers"""
+    index = {}
+    with open(filename) as f:
+        for row in csv.DictReader(f):
+            index[row['title']] = row['identifier']
+    return index
+
+
+def scan_pids(file: str, archive_identifier: Dict[str, str]) -> Tuple[str, str]:
+    """Returns the persistent identifiers of the scan and of its text for a PageXML file"""
+    # TODO: remove hardcoded urls
+    # scan.transkribus_uri = "https://files.transkribus.eu/iiif/2/MOQMINPXXPUTISCRFIRKIOIX/full/max/0/default.jpg"
+    path_parts = file.split('/')
+    archive_title = path_parts[-2]
+    if archive_title in archive_identifier:
+        inv_num = archive_identifier[archive_title]
+    else:
+        raise NoArchiveIDError
+    base_name = path_parts[-1].split('.')[0]
+    return (f"https://data.goldenagents.org/datasets/saa/ead/{inv_num}/scans/{base_name}",
+            f"https://data.goldenagents.org/datasets/saa/ead/{inv_num}/texts/{base_name}")
+
+
+def result_sources(ner_results: List[dict]) -> List[str]:
+    """Returns the resources (lexicons, variant lists) that contributed variants to the matching results of a line"""
+    return sorted({lexicon for result in ner_results for variant in result['variants'] for lexicon in variant['lexicons']})
+
+
 def random_annotation_id() -> str:
     return f'https://data.goldenagents.org/datasets/annotations/{uuid.uuid4()}'
 
 
 class NER:
-    def __init__(self, configfile: str):
+    def __init__(self, configfile: str, matchcache_size: int = 0, matchcache_file: Optional[str] = None,
+                 threads: int = 1, profile: bool = False):
         """Instantiates a NER tagger with variantmodel; loads all lexicons specified in the configuration
-         (and parameters)"""
+         (and parameters). If matchcache_size is non-zero, the results of matching a line are cached (and persisted
+         to matchcache_file if set). The lines of a scan are matched in parallel by the specified number of threads.
+         If profile is set, the time spent in each stage of the pipeline is recorded in the statistics."""
+        self.config = self.read_config(configfile)
+        self.configfile = configfile
+        self._fingerprint = None
+        self.statistics = Counter()
+        self.profile = profile
+        # timestamp for the annotations, set for each scan
+        self.timestamp = now()
+        if matchcache_size > 0:
+            self.matchcache = MatchCache(matchcache_size, matchcache_file)
+        else:
+            self.matchcache = None
+        self.matchcache_file = matchcache_file
+        # records of the processed lines (if enabled by record_lines())
+        self.line_records = None
+        self.threads = threads
+        self._executor = None
+        self._executor_pid = None
+
+        self.apply_settings()
+        self.build_model()
+
+    @staticmethod
+    def read_config(configfile: str) -> dict:
+        """Reads and validates a configuration file"""
         with open(configfile, 'rb') as f:
-            self.config = json.load(f)
+            config = json.load(f)
         for key in ("lexicons", "searchparameters", "alphabet", "weights"):
-            if key not in self.config:
+            if key not in config:
                 raise ValueError(f"Missing required key in configuration file: {key}")
+        if ARCHIVE_IDENTIFIERS not in config:
+            raise Exception(f"config file should have an '{ARCHIVE_IDENTIFIERS}' entry linking to a file like "
+                            f"resources/archive_identifiers.tsv.")
+        return config
+
+    @staticmethod
+    def model_definition(config: dict, configfile: str) -> dict:
+        """Returns the part of a configuration that determines the variant model (as opposed to the settings that can
+        be changed on a built model, like the search parameters)"""
+        return {
+            'alphabet': fixpath(config['alphabet'], configfile),
+            'weights': config['weights'],
+            'lexicons': {category: fixpath(filepath, configfile) for category, filepath in config['lexicons'].items()},
+            'variantlists': {category: fixpath(filepath, configfile)
+                             for category, filepath in config.get('variantlists', {}).items()},
+            'lm': [fixpath(filepath, configfile) for filepath in config.get('lm', [])],
+            'contextrules': config.get('contextrules'),
+            'debug': config.get('debug', 0),
+        }
+
+    def build_model(self):
+        """Builds the variant model from the alphabet, weights, lexicons, variant lists, language models and context
+        rules in the configuration"""
+        configfile = self.configfile
         self.category_dict = {fixpath(filepath, configfile): category for category, filepath in
                               self.config['lexicons'].items()}
         if 'variantlists' in self.config:
             self.category_dict.update(
                 {fixpath(filepath, configfile): category for category, filepath in self.config['variantlists'].items()})
-        self.config['searchparameters'][
-            'unicodeoffsets'] = True  # force usage of unicode points in offsets (rather than UTF-8 bytes)
-        self.params = SearchParameters(**self.config['searchparameters'])
-        print("Search Parameters: ", self.params.to_dict(), file=sys.stderr)
         abcfile = self.config['alphabet']
         if abcfile[0] != '/':
             # relative path:
@@ -85,9 +200,6 @@ class NER:
         print("Debug: ", self.config.get('debug', 0), file=sys.stderr)
         self.model = VariantModel(abcfile, weights, debug=self.config.get('debug', 0))
 
-
-            
-
         if 'lexicons' in self.config:
             for filepath in self.config['lexicons'].values():
                 filepath = fixpath(filepath, configfile)
@@ -113,6 +225,21 @@ class NER:
         else:
             self.has_contextrules = False
 
+        self.model.build()
+
+    def apply_settings(self):
+        """Applies everything in the configuration that does not require (re)building the model: the search
+        parameters, resource and observation identifiers, boedeltermen, HTR corrections and archive identifiers"""
+        self.config['searchparameters'][
+            'unicodeoffsets'] = True  # force usage of unicode points in offsets (rather than UTF-8 bytes)
+        self.params = SearchParameters(**self.config['searchparameters'])
+        print("Search Parameters: ", self.params.to_dict(), file=sys.stderr)
+        if self.matchcache is not None:
+            self.params_fingerprint = params_fingerprint(self.params)
+            if self.matchcache_file:
+                # persisted results are only valid for the very same model
+                self.params_fingerprint += ":" + self.fingerprint()
+
         if 'resourceids' in self.config:
             self.resource_ids = self.config['resourceids']
             self.has_resource_ids = True
@@ -127,66 +254,178 @@ class NER:
 
         if self.config.get('boedeltermen'):
             self.read_boedeltermen(self.config['boedeltermen'])
-                
+        else:
+            self.boedeltermen = Boedeltermen({})
 
-        self.model.build()
         if HTR_CORRECTIONS in self.config:
             corrections_file = self.config[HTR_CORRECTIONS]
             print(f"using htr corrections from {corrections_file}", file=sys.stderr)
             with open(corrections_file) as f:
                 corrections_dict = json.load(f)
             self.htr_corrector = Corrector(corrections_dict)
-
-        if ARCHIVE_IDENTIFIERS in self.config:
-            index = {}
-            with open(self.config[ARCHIVE_IDENTIFIERS]) as f:
-                for row in csv.DictReader(f):
-                    index[row['title']] = row['identifier']
-            self.archive_identifier = index
         else:
-            raise Exception(f"config file should have an '{ARCHIVE_IDENTIFIERS}' entry linking to a file like "
-                            f"resources/archive_identifiers.tsv.")
+            self.htr_corrector = None
+
+        self.archive_identifier = read_archive_identifiers(self.config[ARCHIVE_IDENTIFIERS])
+
+    def reconfigure(self, configfile: str) -> bool:
+        """Switches to another configuration file while keeping the model, which is only possible if the other
+        configuration defines the very same model (see model_definition()); all other settings are applied.
+        Returns False, and changes nothing, if the model would have to be rebuilt."""
+        config = self.read_config(configfile)
+        if self.model_definition(config, configfile) != self.model_definition(self.config, self.configfile):
+            return False
+        self.config = config
+        self.configfile = configfile
+        self._fingerprint = None
+        self.apply_settings()
+        return True
+
+    def find_all_matches(self, text: str) -> List[dict]:
+        """Runs analiticcl on a single line of text, consulting the match cache (if enabled) first"""
+        return self.find_all_matches_batch([text])[0]
+
+    def find_all_matches_batch(self, texts: List[str]) -> List[List[dict]]:
+        """Runs analiticcl on multiple lines of text at once, returns the results for each line (in order).
+        Lines not in the match cache are deduplicated and, if multiple threads are configured, matched in parallel"""
+        batch_results = [None] * len(texts)
+        todo = defaultdict(list)  # text => indices in the batch
+        for i, text in enumerate(texts):
+            if self.matchcache is not None:
+                batch_results[i] = self.matchcache.get(self.params_fingerprint, text)
+            if batch_results[i] is None:
+                todo[text].append(i)
+        if self.matchcache is not None:
+            self.statistics['matchcache_hits'] += len(texts) - len(todo)
+            self.statistics['matchcache_misses'] += len(todo)
+        if self.threads > 1 and len(todo) > 1:
+            matches = self.executor().map(self._find_all_matches_uncached, todo.keys())
+        else:
+            matches = map(self._find_all_matches_uncached, todo.keys())
+        for (text, indices), results in zip(todo.items(), matches):
+            if self.matchcache is not None:
+                self.matchcache.put(self.params_fingerprint, text, results)
+            batch_results[indices[0]] = results
+            for i in indices[1:]:
+                # each line gets its own result dictionaries as they are amended later
+                batch_results[i] = [dict(result) for result in results]
+        return batch_results
+
+    def _find_all_matches_uncached(self, text: str) -> List[dict]:
+        return self.model.find_all_matches(text, self.params)
+
+    def executor(self) -> ThreadPoolExecutor:
+        """Returns the thread pool for matching; it is created lazily as threads do not survive forking"""
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.threads)
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def stage(self, name: str):
+        """Returns a context manager timing a stage of the pipeline (if profiling is enabled)"""
+        if self.profile:
+            return StageTimer(self.statistics, name)
+        return NULL_TIMER
+
+    def pop_statistics(self) -> Counter:
+        """Returns the statistics gathered so far and resets them"""
+        statistics = self.statistics
+        self.statistics = Counter()
+        return statistics
+
+    def print_statistics(self, statistics: Optional[Counter] = None, elapsed: Optional[float] = None):
+        """Prints statistics to standard error; if no statistics are passed, the ones gathered by this instance are used"""
+        if statistics is None:
+            statistics = self.statistics
+        if self.profile:
+            print_profile(statistics, elapsed)
+        if statistics['scans']:
+            print(f"Processed {statistics['scans']} scans, {statistics['lines']} lines, {statistics['matches']} matches, "
+                  f"{statistics['annotations']} annotations", file=sys.stderr)
+        if statistics['boedeltermen_misses']:
+            print(f"No boedeltermen URIs found for {statistics['boedeltermen_misses']} tagged variants", file=sys.stderr)
+        if statistics['parse_fallbacks']:
+            print(f"Used the full PageXML parser for {statistics['parse_fallbacks']} files", file=sys.stderr)
+        if statistics['resume_skipped']:
+            print(f"Skipped {statistics['resume_skipped']} input files that were already processed", file=sys.stderr)
+        lookups = statistics['matchcache_hits'] + statistics['matchcache_misses']
+        if lookups:
+            print(f"Match cache: {statistics['matchcache_hits']} hits, {statistics['matchcache_misses']} misses "
+                  f"({statistics['matchcache_hits'] / lookups:.1%} hit rate)", file=sys.stderr)
+
+    def fingerprint(self) -> str:
+        """Returns a fingerprint of the configuration file and the content of all resources it references"""
+        if self._fingerprint is None:
+            self._fingerprint = resources_fingerprint(self.configfile, self.resource_files(self.configfile))
+        return self._fingerprint
+
+    def resource_files(self, configfile: str) -> List[str]:
+        """Returns the paths of all resource files referenced by the configuration"""
+        files = [fixpath(self.config['alphabet'], configfile)]
+        for key in ('lexicons', 'variantlists'):
+            files += [fixpath(filepath, configfile) for filepath in self.config.get(key, {}).values()]
+        files += [fixpath(filepath, configfile) for filepath in self.config.get('lm', [])]
+        for key in ('contextrules', 'boedeltermen', HTR_CORRECTIONS, ARCHIVE_IDENTIFIERS):
+            if self.config.get(key):
+                files.append(self.config[key])
+        return files
 
     def read_boedeltermen(self, filename: str):
-        #Reads boedeltermen.csv , maps (type,wordform) tuples to (uri, lemma) pairs (may be multiple because of ambiguity)
-        self.boedeltermen = defaultdict(set) #maps (type,wordform) tuples to (uri, lemma) pairs (may be multiple because of ambiguity)
-        BOEDELTERMEN_LEMMA, BOEDELTERMEN_TYPE, BOEDELTERMEN_NORMWORDFORM, BOEDELTERMEN_VARWORDFORM, BOEDELTERMEN_URI = range(0,5)
-        with open(self.config['boedeltermen'], 'r', encoding='utf-8') as f:
-            for line in f:
-                line = line.strip()
-                if line:
-                    fields = line.split(",")
-                    if fields[BOEDELTERMEN_URI] and fields[BOEDELTERMEN_LEMMA]:
-                        self.boedeltermen[(fields[BOEDELTERMEN_NORMWORDFORM], fields[BOEDELTERMEN_TYPE])].add((fields[BOEDELTERMEN_URI], fields[BOEDELTERMEN_LEMMA]))
+        """Reads boedeltermen.csv (or a prebuilt index), maps (wordform, type) tuples to (uri, lemma) pairs"""
+        self.boedeltermen = Boedeltermen.from_file(filename)
         print(f"Loaded {len(self.boedeltermen)} boedeltermen",file=sys.stderr)
-            
 
     def process_pagexml(self, file: str) -> Optional[Tuple[list, str, list]]:
         """Runs the NER tagging on a PageXML file, returns a list of web annotations"""
+        return self.create_web_annotations(self.read_pagexml(file))
+
+    def read_pagexml(self, file: str):
+        """Parses a PageXML file and assigns the persistent identifiers to the scan"""
         if os.path.islink(file):
             # deference symbolic links, we need the full path info
             file = os.path.realpath(file)
-        scan = parse_pagexml_file(file)
+        with self.stage("parse"):
+            scan = self.parse_pagexml(file)
         if not scan.id:
             scan.id = create_scan_id(file)
-        # TODO: remove hardcoded urls
-        # scan.transkribus_uri = "https://files.transkribus.eu/iiif/2/MOQMINPXXPUTISCRFIRKIOIX/full/max/0/default.jpg"
-        path_parts = file.split('/')
-        archive_title = path_parts[-2]
-        if ARCHIVE_IDENTIFIERS in self.config:
-            if archive_title in self.archive_identifier:
-                inv_num = self.archive_identifier[archive_title]
-            else:
-                raise NoArchiveIDError
-        base_name = path_parts[-1].split('.')[0]
-        scan.pid = f"https://data.goldenagents.org/datasets/saa/ead/{inv_num}/scans/{base_name}"
-        scan.text_pid = f"https://data.goldenagents.org/datasets/saa/ead/{inv_num}/texts/{base_name}"
-        return self.create_web_annotations(scan)
+        scan.pid, scan.text_pid = scan_pids(file, self.archive_identifier)
+        return scan
+
+    def parse_pagexml(self, file: str):
+        """Reads the lines from a PageXML file with the streaming reader, falls back to the full parser for files the
+        streaming reader does not support (or if configured with "pagexml-parser": "full")"""
+        stream = self.config.get('pagexml-parser', 'stream') == 'stream'
+        scan = read_pagexml_file(file, stream=stream)
+        if stream and not isinstance(scan, StreamedScan):
+            self.statistics['parse_fallbacks'] += 1
+        return scan
 
     def create_web_annotation_observation(self, ner_results, text_line: PageXMLTextLine, line_offset: int,
                                           text_pid: str, scan_pid: str):
         """Extract larger tagged entities, which we call 'observations' from NER results
          and creates web annotations for them."""
+        # First pass: find the sequences. A result with sequence number s > 0 for a tag continues the sequence that
+        # starts s results earlier, provided that all results in between carry the tag as well.
+        sequences = defaultdict(list)  # (index of the first result, tag) => indices of the continuing results
+        run_start = {}  # tag => index of the first result of the current uninterrupted run of results with this tag
+        last_seen = {}  # tag => index of the last result with this tag
+        for k, ner_result in enumerate(ner_results):
+            tags = ner_result.get('tag')
+            if not tags:
+                continue
+            seqnrs = ner_result.get('seqnr', [])
+            for idx, tag in enumerate(tags):
+                if tag not in self.observation_ids or tags.index(tag) != idx:
+                    # only tags that can be observations, and only the first occurrence of a tag counts
+                    continue
+                if last_seen.get(tag) != k - 1:
+                    run_start[tag] = k
+                last_seen[tag] = k
+                seqnr = seqnrs[idx]
+                if seqnr > 0 and k - seqnr >= run_start[tag]:
+                    sequences[(k - seqnr, tag)].append(k)
+
+        # Second pass: create an observation for each sequence (of more than one result), in order of their start
         for i, ner_result in enumerate(ner_results):
             if ner_result['variants']:
                 for (tag, seqnr) in zip(ner_result.get('tag', []), ner_result.get('seqnr', [])):
@@ -199,108 +438,188 @@ class NER:
                         # only process tags that can be observations
                         continue
 
-                    length = 1
-                    if 'annotations' in ner_result:
-                        provenance = deepcopy(ner_result['annotations'])
-                    else:
-                        provenance = []
+                    sequence = sequences.get((i, tag))
+                    if not sequence:
+                        continue
+
+                    provenance = list(ner_result.get('annotations', ()))
 
-                    # find the rest of the sequence; aggregate text of the top variants
+                    # aggregate text of the top variants
                     variant_text = ner_result['variants'][0]['text']
-                    last_ner_result = ner_result
-                    for j, ner_result2 in enumerate(ner_results[i + 1:]):
-                        try:
-                            idx = ner_result2.get('tag', []).index(tag)
-                        except ValueError:
-                            break
-                        if ner_result2.get('seqnr', [])[idx] == j + 1:
-                            length += 1
-                            if 'variants' in ner_result2 and ner_result2['variants']:
-                                variant_text += " " + ner_result2['variants'][0]['text']
-                            else:
-                                print(f"WARNING: Did not find text for seqnr {j}, tag {tag} (variant_text buffer={variant_text})", file=sys.stderr)
-                            last_ner_result = ner_result2
-                            if 'annotations' in ner_result2:
-                                provenance += ner_result2['annotations']
-                    if length > 1:
-                        xywh = f"{text_line.coords.x},{text_line.coords.y},{text_line.coords.w},{text_line.coords.h}"
-                        yield {
-                            "@context": ["http://www.w3.org/ns/anno.jsonld", {"prov": "http://www.w3.org/ns/prov#"}],
-                            "id": random_annotation_id(),
-                            "type": "Annotation",
-                            "motivation": [
-                                "classifying",
-                            ],
-                            "generated": now(),
-                            "generator": {
-                                "id": "https://github.com/knaw-huc/golden-agents-htr",
-                                "type": "Software",
-                                "name": "GoldenAgentsNER"
-                            },
-                            "body": self.observation_body(type=tag, label=variant_text, provenance=provenance),
-                            "target": [
-                                {
-                                    "source": text_pid,
-                                    "type": "Text",
-                                    "selector": [
-                                        {
-                                            "type": "TextPositionSelector",
-                                            "start": line_offset + ner_result['offset']['begin'],
-                                            "end": line_offset + last_ner_result['offset']['end']
-                                        },
-                                        {
-                                            "type": "TextQuoteSelector",
-                                            "exact": text_line.text[
-                                                     ner_result['offset']['begin']:last_ner_result['offset']['end']],
-                                            "prefix": text_line.text[:ner_result['offset']['begin']],
-                                            "suffix": text_line.text[last_ner_result['offset']['end']:],
-                                        }
-                                    ]
-                                },
-                                {
-                                    "source": scan_pid,
-                                    "type": "Image",
-                                    "selector": {
-                                        "type": "FragmentSelector",
-                                        "conformsTo": "http://www.w3.org/TR/media-frags/",
-                                        "value": f"xywh={xywh}"
-                                    }
-                                }
-                            ]
-                        }
+                    for k in sequence:
+                        ner_result2 = ner_results[k]
+                        if ner_result2.get('variants'):
+                            variant_text += " " + ner_result2['variants'][0]['text']
+                        else:
+                            print(f"WARNING: Did not find text for seqnr {k - i - 1}, tag {tag} (variant_text buffer={variant_text})", file=sys.stderr)
+                        if 'annotations' in ner_result2:
+                            provenance += ner_result2['annotations']
+                    last_ner_result = ner_results[sequence[-1]]
+
+                    xywh = f"{text_line.coords.x},{text_line.coords.y},{text_line.coords.w},{text_line.coords.h}"
+                    yield {
+                        "@context": OBSERVATION_CONTEXT,
+                        "id": random_annotation_id(),
+                        "type": "Annotation",
+                        "motivation": MOTIVATION_CLASSIFYING,
+                        "generated": self.timestamp,
+                        "generator": GENERATOR,
+                        "body": self.observation_body(type=tag, label=variant_text, provenance=provenance),
+                        "target": [
+                            text_target(text_pid, text_line.text, line_offset, ner_result['offset']['begin'],
+                                        last_ner_result['offset']['end']),
+                            image_target(scan_pid, xywh)
+                        ]
+                    }
 
     def create_web_annotations(self, scan) -> Tuple[List[dict], str, List[dict]]:
         """Find lines in the scan and pass them to the tagger, producing web-annotations"""
+        return self.collect_web_annotations(self.iter_web_annotations(scan))
+
+    def create_web_annotations_batch(self, scans: List[Any], return_exceptions: bool = False) \
+            -> List[Union[Tuple[List[dict], str, List[dict]], Exception]]:
+        """Like create_web_annotations(), for multiple scans at once: the lines of all scans are matched in a single
+        batch. If return_exceptions is set, an error in a scan is returned in place of its result (and does not affect
+        the other scans), otherwise it is raised."""
+        prepared = []
+        for scan in scans:
+            try:
+                prepared.append(self.prepare_lines(scan))
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                prepared.append(e)
+        with self.stage("matching"):
+            batch_results = self.find_all_matches_batch(
+                [text for scan_lines in prepared if not isinstance(scan_lines, Exception) for text in scan_lines[1]])
+        results = []
+        offset = 0
+        for scan, scan_lines in zip(scans, prepared):
+            if isinstance(scan_lines, Exception):
+                results.append(scan_lines)
+                continue
+            text_lines, texts = scan_lines
+            scan_results = batch_results[offset:offset + len(texts)]
+            offset += len(texts)
+            try:
+                results.append(self.collect_web_annotations(self.annotate_lines(scan, text_lines, texts,
+                                                                                scan_results)))
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                results.append(e)
+        return results
+
+    @staticmethod
+    def collect_web_annotations(lines: Iterable[Tuple[str, List[dict], List[dict]]]) \
+            -> Tuple[List[dict], str, List[dict]]:
+        """Gathers the output of iter_web_annotations() into the annotations, plain text and raw results"""
         annotations = []
         plain_text = ''
         raw_results = []
-        for tl in [l for l in scan.get_lines() if l.text]:
-            text = tl.text
-            if hasattr(self, 'htr_corrector') and self.htr_corrector:
-                text = self.htr_corrector.correct(text)
-            ner_results = self.model.find_all_matches(text, self.params)
-            for result in ner_results:
-                raw_results.append(result)
-                if (
-                        len(result['variants']) > 0
-                        and result['variants'][0]['score'] >= self.config.get('score-threshold', 0)
-                ):
-                    xywh = f"{tl.coords.x},{tl.coords.y},{tl.coords.w},{tl.coords.h}"
+        for text, ner_results, line_annotations in lines:
+            raw_results += ner_results
+            annotations += line_annotations
+            plain_text += f"{text}\n"
+        return annotations, plain_text, raw_results
+
+    def iter_web_annotations(self, scan) -> Generator[Tuple[str, List[dict], List[dict]], None, None]:
+        """Find lines in the scan and pass them to the tagger, yields the (corrected) text, the raw results and the
+        web-annotations for each line as soon as the line is done"""
+        text_lines, texts = self.prepare_lines(scan)
+        # all lines of the scan are matched in one batch
+        with self.stage("matching"):
+            batch_results = self.find_all_matches_batch(texts)
+        yield from self.annotate_lines(scan, text_lines, texts, batch_results)
+
+    def prepare_lines(self, scan) -> Tuple[list, List[str]]:
+        """Returns the lines of the scan that have text, and their texts with the HTR corrections applied"""
+        text_lines = [l for l in scan.get_lines() if l.text]
+        if self.htr_corrector:
+            with self.stage("correction"):
+                texts = [self.htr_corrector.correct(tl.text) for tl in text_lines]
+        else:
+            texts = [tl.text for tl in text_lines]
+        self.statistics['scans'] += 1
+        self.statistics['lines'] += len(text_lines)
+        if self.profile:
+            self.statistics['tokens'] += sum(len(text.split()) for text in texts)
+        return text_lines, texts
+
+    def annotate_lines(self, scan, text_lines: list, texts: List[str], batch_results: List[List[dict]]) \
+            -> Generator[Tuple[str, List[dict], List[dict]], None, None]:
+        """Creates the web-annotations for the matching results of the lines of a scan, yields the text, the raw
+        results and the web-annotations per line"""
+        # all annotations of a scan share one timestamp
+        self.timestamp = now()
+        if self.line_records is not None:
+            scan_record = {"id": scan.id, "pid": scan.pid, "text_pid": scan.text_pid, "lines": []}
+            self.line_records.append(scan_record)
+        line_offset = 0
+        for tl, text, ner_results in zip(text_lines, texts, batch_results):
+            annotations = self.annotate_line(scan, tl, text, ner_results, line_offset)
+            if self.line_records is not None:
+                scan_record["lines"].append(self.line_record(tl, text, line_offset, ner_results, annotations))
+            line_offset += len(text) + 1
+            yield text, ner_results, annotations
+
+    def annotate_line(self, scan, tl, text: str, ner_results: List[dict], line_offset: int) -> List[dict]:
+        """Creates the web-annotations for the matching results of a single line, which starts at line_offset in the
+        text of the scan"""
+        self.statistics['matches'] += len(ner_results)
+        annotations = []
+        xywh = f"{tl.coords.x},{tl.coords.y},{tl.coords.w},{tl.coords.h}"
+        for result in ner_results:
+            if (
+                    len(result['variants']) > 0
+                    and result['variants'][0]['score'] >= self.config.get('score-threshold', 0)
+            ):
+                with self.stage("annotation"):
                     new_annotations = list(
                         self.create_web_annotation(text_line=tl, ner_result=result, scan_pid=scan.pid, xywh=xywh,
                                                    text_pid=scan.text_pid,
-                                                   line_offset=len(plain_text)))
-                    annotations += new_annotations
-                    result['annotations'] = [x['id'] for x in new_annotations]
-            plain_text += f"{text}\n"
-            if self.has_contextrules:
-                # observations are annotations of multi-span entitities from the context rules
-                # (see https://github.com/knaw-huc/golden-agents-htr/issues/22 for discussion)
+                                                   line_offset=line_offset))
+                annotations += new_annotations
+                result['annotations'] = [x['id'] for x in new_annotations]
+        if self.has_contextrules:
+            # observations are annotations of multi-span entitities from the context rules
+            # (see https://github.com/knaw-huc/golden-agents-htr/issues/22 for discussion)
+            with self.stage("observations"):
                 for entity_wa in self.create_web_annotation_observation(ner_results=ner_results, text_line=tl,
-                                                                        line_offset=len(plain_text),
+                                                                        line_offset=line_offset + len(text) + 1,
                                                                         scan_pid=scan.pid, text_pid=scan.text_pid):
                     annotations.append(entity_wa)
-        return annotations, plain_text, raw_results
+        self.statistics['annotations'] += len(annotations)
+        return annotations
+
+    def record_lines(self, enabled: bool = True):
+        """Enables (or disables) recording what was found on each line, see pop_line_records()"""
+        self.line_records = [] if enabled else None
+
+    def pop_line_records(self) -> List[dict]:
+        """Returns the records of the scans processed since the last call: per scan its identifiers and, per line,
+        the line's identifier, coordinates, (raw and corrected) text and offset, the identifiers of its annotations,
+        the resources (lexicons, variant lists) its matches came from and the best variant of each match"""
+        records = self.line_records or []
+        if self.line_records is not None:
+            self.line_records = []
+        return records
+
+    @staticmethod
+    def line_record(tl, text: str, line_offset: int, ner_results: List[dict], annotations: List[dict]) -> dict:
+        return {
+            "id": tl.id,
+            "raw_text": tl.text,
+            "text": text,
+            "coords": [tl.coords.x, tl.coords.y, tl.coords.w, tl.coords.h],
+            "offset": line_offset,
+            "annotations": [annotation['id'] for annotation in annotations],
+            "sources": result_sources(ner_results),
+            # matched text, best variant, score and offsets in the (corrected) text
+            "matches": [[result['input'], result['variants'][0]['text'], result['variants'][0]['score'],
+                         result['offset']['begin'], result['offset']['end']]
+                        for result in ner_results if result['variants']],
+        }
 
     def create_web_annotation(self, text_line: PageXMLTextLine, ner_result, scan_pid, xywh, text_pid, line_offset: int):
         """Convert analiticcl's output to web annotation, may output multiple web annotations in case of ties
@@ -348,53 +667,24 @@ class NER:
                 bodies.append({
                     "type": "TextualBody",
                     "value": top_variant['text'],
-                    "modified": now(),
+                    "modified": self.timestamp,
                     "purpose": "editing",
                 })
             bodies += tag_bodies
             bodies += variantmatch_bodies
             yield {
-                "@context": "http://www.w3.org/ns/anno.jsonld",
+                "@context": ANNOTATION_CONTEXT,
                 "id": random_annotation_id(),
                 "type": "Annotation",
-                "motivation": [
-                    "classifying",
-                    "editing"
-                ],
-                "generated": now(),
-                "generator": {
-                    "id": "https://github.com/knaw-huc/golden-agents-htr",
-                    "type": "Software",
-                    "name": "GoldenAgentsNER"
-                },
+                "motivation": MOTIVATION_CLASSIFYING_EDITING,
+                "generated": self.timestamp,
+                "generator": GENERATOR,
                 "body": bodies,
                 "target": [
-                    {
-                        "source": text_pid,
-                        "type": "Text",
-                        "selector": [
-                            {
-                                "type": "TextPositionSelector",
-                                "start": line_offset + ner_result['offset']['begin'],
-                                "end": line_offset + ner_result['offset']['end']
-                            }, {
-                                "type": "TextQuoteSelector",
-                                "exact": text_line.text[ner_result['offset']['begin']:ner_result['offset']['end']],
-                                "prefix": text_line.text[:ner_result['offset']['begin']],
-                                "suffix": text_line.text[ner_result['offset']['end']:],
-                            }
-                        ]
-                    },
-                    {
-                        "source": scan_pid,
-                        "type": "Image",
-                        "selector": {
-                            "type": "FragmentSelector",
-                            "conformsTo": "http://www.w3.org/TR/media-frags/",
-                            "value": f"xywh={xywh}"
-                        }
-                    }]
-
+                    text_target(text_pid, text_line.text, line_offset, ner_result['offset']['begin'],
+                                ner_result['offset']['end']),
+                    image_target(scan_pid, xywh)
+                ]
             }
             if self.has_contextrules:
                 # ties are already resolved by analiticcl if there are context rules
@@ -410,7 +700,7 @@ class NER:
             body = {
                 "type": "SpecificResource",
                 "purpose": "tagging",
-                "modified": now(),
+                "modified": self.timestamp,
                 "source": {
                     "id": self.resource_ids[label],
                     "label": label
@@ -425,18 +715,19 @@ class NER:
             return {
                 "type": "TextualBody",
                 "value": label,
-                "modified": now(),
+                "modified": self.timestamp,
                 "purpose": "tagging"
             }
 
     def resource_tagging_body(self, variant: str, category: str, confidence: Optional[float] = None, provenance: Optional[str] = None) -> Generator[Dict[ str, Any],None,None]:
         """Tags with specific resource URIs from boedeltermen"""
-        if (variant, category) in self.boedeltermen:
-            for (uri, lemma) in self.boedeltermen[(variant,category)]:
+        resources = self.boedeltermen.get(variant, category)
+        if resources:
+            for (uri, lemma) in resources:
                 body = {
                     "type": "SpecificResource",
                     "purpose": "tagging",
-                    "modified": now(),
+                    "modified": self.timestamp,
                     "source": {
                         "id": uri,
                         "label": lemma
@@ -448,7 +739,10 @@ class NER:
                     body['provenance'] = provenance
                 yield body
         else:
-            print(f"No URIs for {variant},{category}",file=sys.stderr)
+            # misses are only counted (and reported at the end), printing each would flood standard error
+            self.statistics['boedeltermen_misses'] += 1
+            if self.config.get('debug'):
+                print(f"No URIs for {variant},{category}",file=sys.stderr)
 
     def observation_body(self, type: str, label: str, provenance: Optional[list] = None) -> Dict[str, Any]:
         if not self.has_observation_ids or type not in self.observation_ids:
@@ -457,7 +751,7 @@ class NER:
         return {
             "type": type,
             "label": label,
-            "modified": now(),
+            "modified": self.timestamp,
             "prov:wasDerivedFrom": provenance,
         }
 
@@ -0,0 +1,166 @@
+import io
+import xml.etree.ElementTree as ET
+from typing import Dict, Generator, List, Optional
+
+from pagexml.model.physical_document_model import Coords, is_horizontally_overlapping
+from pagexml.parser import parse_pagexml_file
+
+
+class UnsupportedPageXML(Exception):
+    """Raised by the streaming reader for PageXML it does not handle (identically to the full parser), the caller
+    should fall back to the full parser"""
+    pass
+
+
+class TextLine:
+    """A text line with only the information the NER needs"""
+
+    __slots__ = ('id', 'text', 'coords')
+
+    def __init__(self, line_id: Optional[str], text: Optional[str], coords: Coords):
+        self.id = line_id
+        self.text = text
+        self.coords = coords
+
+
+class TextRegion:
+    """A top-level text region, holds its lines (in document order) until the regions can be ordered"""
+
+    __slots__ = ('id', 'coords', 'lines')
+
+    def __init__(self, region_id: Optional[str], coords: Coords, lines: List[TextLine]):
+        self.id = region_id
+        self.coords = coords
+        self.lines = lines
+
+    def __lt__(self, other: 'TextRegion'):
+        """Same ordering as pagexml's PageXMLTextRegion: left to right, top to bottom if horizontally overlapping"""
+        if other is self:
+            return False
+        if is_horizontally_overlapping(self, other):
+            return self.coords.top < other.coords.top
+        else:
+            return self.coords.left < other.coords.left
+
+
+class StreamedScan:
+    """A scan read by the streaming reader, a light-weight stand-in for pagexml's PageXMLScan"""
+
+    def __init__(self, scan_id: str, text_regions: List[TextRegion], reading_order: Dict[int, str], filename: str):
+        self.id = scan_id
+        self.text_regions = text_regions
+        self.reading_order = reading_order
+        self.metadata = {'filename': filename}
+
+    def get_lines(self) -> Generator[TextLine, None, None]:
+        """Yields the lines in the same order as PageXMLScan.get_lines() would return them"""
+        text_regions = self.text_regions
+        reading_order_number = {region_id: number for number, region_id in self.reading_order.items()}
+        if reading_order_number and all(tr.id in reading_order_number for tr in text_regions):
+            text_regions = sorted(text_regions, key=lambda tr: reading_order_number[tr.id])
+        else:
+            text_regions = sorted(text_regions)
+        for text_region in text_regions:
+            yield from text_region.lines
+
+
+def localname(tag: str) -> str:
+    return tag.rsplit('}', 1)[-1]
+
+
+def element_coords(element: ET.Element) -> Coords:
+    """Returns the coordinates of the single Coords child of an element"""
+    coords = [child for child in element if localname(child.tag) == 'Coords']
+    if len(coords) != 1 or not coords[0].get('points'):
+        raise UnsupportedPageXML(f"{localname(element.tag)} {element.get('id')} has no (single) coordinates")
+    try:
+        return Coords(points=coords[0].get('points'))
+    except ValueError as err:
+        raise UnsupportedPageXML(str(err))
+
+
+def element_text(element: ET.Element) -> Optional[str]:
+    """Returns the text of an element the way xmltodict (used by the full parser) does"""
+    if len(element) or element.attrib:
+        raise UnsupportedPageXML(f"Unexpected structure in {localname(element.tag)}")
+    return element.text.strip() or None if element.text else None
+
+
+def textline_text(textline: ET.Element) -> Optional[str]:
+    """Returns the text of the TextEquiv of a text line (Unicode, or PlainText if there is no Unicode)"""
+    text_equivs = [child for child in textline if localname(child.tag) == 'TextEquiv']
+    if not text_equivs:
+        return None
+    elif len(text_equivs) > 1:
+        raise UnsupportedPageXML(f"Multiple TextEquiv elements in TextLine {textline.get('id')}")
+    text_equiv = text_equivs[0]
+    if not len(text_equiv):
+        return None if text_equiv.attrib else element_text(text_equiv)
+    for name in ('Unicode', 'PlainText'):
+        children = [child for child in text_equiv if localname(child.tag) == name]
+        if len(children) > 1:
+            raise UnsupportedPageXML(f"Multiple {name} elements in TextLine {textline.get('id')}")
+        elif children:
+            return element_text(children[0])
+    return None
+
+
+def stream_pagexml_file(pagexml_file: str, pagexml_data: Optional[bytes] = None) -> StreamedScan:
+    """Reads the text lines (id, coordinates and text) from a PageXML file (or from its content passed separately)
+    with an incremental parser, elements are discarded as soon as they are read. Raises UnsupportedPageXML for
+    anything beyond plain text regions with lines (nested regions, missing coordinates, etc.)"""
+    scan_id = pagexml_file
+    text_regions: List[TextRegion] = []
+    reading_order: Dict[int, str] = {}
+    lines: List[TextLine] = []
+    ordered_groups = 0
+    path: List[str] = []
+    source = io.BytesIO(pagexml_data) if pagexml_data is not None else pagexml_file
+    for event, element in ET.iterparse(source, events=('start', 'end')):
+        name = localname(element.tag)
+        if event == 'start':
+            path.append(name)
+            if len(path) == 1 and name != 'PcGts':
+                raise UnsupportedPageXML(f"Not a PageXML file: {pagexml_file}")
+            elif name == 'Page' and element.get('imageFilename') is not None:
+                scan_id = element.get('imageFilename')
+            elif name == 'TextRegion' and path[:-1] != ['PcGts', 'Page']:
+                raise UnsupportedPageXML("Nested text regions")
+            elif name == 'TextLine' and path[:-1] != ['PcGts', 'Page', 'TextRegion']:
+                raise UnsupportedPageXML("Text line outside a top-level text region")
+            elif name == 'OrderedGroup' and path[:-1] == ['PcGts', 'Page', 'ReadingOrder']:
+                ordered_groups += 1
+                if ordered_groups > 1:
+                    raise UnsupportedPageXML("Multiple ordered groups in the reading order")
+            continue
+        path.pop()
+        if name == 'TextLine':
+            lines.append(TextLine(element.get('id'), textline_text(element), element_coords(element)))
+            element.clear()
+        elif name == 'TextRegion':
+            text_regions.append(TextRegion(element.get('id'), element_coords(element), lines))
+            lines = []
+            element.clear()
+        elif name == 'RegionRefIndexed' and path == ['PcGts', 'Page', 'ReadingOrder', 'OrderedGroup']:
+            if element.get('regionRef') is not None:
+                try:
+                    reading_order[int(element.get('index'))] = element.get('regionRef')
+                except (TypeError, ValueError):
+                    raise UnsupportedPageXML(f"Invalid reading order index for {element.get('regionRef')}")
+    if len({tr.id for tr in text_regions}) != len(text_regions):
+        # the full parser keeps only one region per identifier when applying the reading order
+        raise UnsupportedPageXML("Duplicate text region identifiers")
+    return StreamedScan(scan_id, text_regions, reading_order, pagexml_file)
+
+
+def read_pagexml_file(pagexml_file: str, stream: bool = True, pagexml_data: Optional[bytes] = None):
+    """Reads a PageXML file (or its content passed separately) with the streaming reader if possible, falls back to
+    pagexml's full parser otherwise (or if stream is False). Returns a StreamedScan or a PageXMLScan respectively."""
+    if stream:
+        try:
+            return stream_pagexml_file(pagexml_file, pagexml_data)
+        except (UnsupportedPageXML, ET.ParseError):
+            pass
+    if pagexml_data is not None:
+        return parse_pagexml_file(pagexml_file, pagexml_data=pagexml_data.decode('utf-8'))
+    return parse_pagexml_file(pagexml_file)
@@ -0,0 +1,75 @@
+import sys
+from collections import Counter
+from time import perf_counter
+from typing import Optional, TextIO
+
+# The stages of the pipeline that are timed when profiling
+STAGES = ("parse", "correction", "matching", "annotation", "observations", "serialization")
+# Counters reported per file
+COUNTERS = ("scans", "lines", "tokens", "matches", "annotations")
+
+
+class StageTimer:
+    """Context manager adding the wall time spent in a stage (and the number of calls) to a statistics counter"""
+
+    __slots__ = ("statistics", "name", "start")
+
+    def __init__(self, statistics: Counter, name: str):
+        self.statistics = statistics
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.statistics[f"time_{self.name}"] += perf_counter() - self.start
+        self.statistics[f"calls_{self.name}"] += 1
+
+
+class NullTimer:
+    """Stand-in for StageTimer when profiling is disabled"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return None
+
+
+NULL_TIMER = NullTimer()
+
+
+class ProfileReport:
+    """Writes the counters and stage timings of each processed file as a row to a TSV file"""
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._file = open(filename, 'w', encoding='utf-8')
+        self._file.write("\t".join(("file",) + COUNTERS + tuple(f"time_{stage}" for stage in STAGES)) + "\n")
+
+    def add(self, pagexmlfile: str, statistics: Counter):
+        row = [pagexmlfile]
+        row += [str(statistics.get(counter, 0)) for counter in COUNTERS]
+        row += [f"{statistics.get(f'time_{stage}', 0.0):.6f}" for stage in STAGES]
+        self._file.write("\t".join(row) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def print_profile(statistics: Counter, elapsed: Optional[float] = None, file: TextIO = sys.stderr):
+    """Prints a summary of the stage timings and the throughput"""
+    total = sum(statistics.get(f"time_{stage}", 0.0) for stage in STAGES)
+    print(f"{'stage':<16}{'calls':>10}{'time (s)':>12}{'share':>8}", file=file)
+    for stage in STAGES:
+        duration = statistics.get(f"time_{stage}", 0.0)
+        print(f"{stage:<16}{statistics.get(f'calls_{stage}', 0):>10}{duration:>12.3f}"
+              f"{duration / total if total else 0.0:>8.1%}", file=file)
+    if elapsed:
+        print(f"Elapsed {elapsed:.3f}s: {statistics['scans'] / elapsed:.2f} scans/s, "
+              f"{statistics['lines'] / elapsed:.1f} lines/s, {statistics['tokens'] / elapsed:.1f} tokens/s", file=file)
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import math
+import os.path
+import re
+import sys
+from types import SimpleNamespace
+from typing import Dict, Iterable, List, Set, Tuple, Union
+
+from golden_agents_ner.cli import dumps_jsonl
+from golden_agents_ner.lineindex import LineIndex, normalize_tokens
+from golden_agents_ner.manifest import Manifest
+from golden_agents_ner.ner import NER, fixpath, now
+from golden_agents_ner.pagexmlreader import TextLine
+from golden_agents_ner.scancache import Box
+from golden_agents_ner.writer import open_input, open_output, uncompressed_name
+
+NUMBER_PATTERN = re.compile(r"^-?[0-9.]+$")
+
+
+def resource_rows(filename: str) -> Set[str]:
+    with open(filename, 'r', encoding='utf-8') as f:
+        return {line.rstrip("\n") for line in f if line.strip() and not line.startswith("#")}
+
+
+def changed_rows(oldfile: str, newfile: str) -> Set[str]:
+    """Returns the rows that were added, removed or modified between two versions of a resource"""
+    return resource_rows(oldfile) ^ resource_rows(newfile)
+
+
+def row_words(row: str) -> Set[str]:
+    """Returns the normalised words in a row of a lexicon or variant list (all non-numeric fields)"""
+    words = set()
+    for field in row.split("\t"):
+        if not NUMBER_PATTERN.match(field.strip()):
+            words |= normalize_tokens(field)
+    return words
+
+
+def rule_references(row: str) -> Tuple[Set[str], Set[str]]:
+    """Returns the lexicons (by filename) referenced by a context rule and the normalised words it contains"""
+    lexicons, words = set(), set()
+    pattern = row.split("\t")[0]
+    for element in re.split(r"[;|]", pattern):
+        element = element.strip().lstrip("!")
+        if element.startswith("@"):
+            lexicons.add(os.path.basename(element[1:]))
+        else:
+            words |= normalize_tokens(element)
+    return lexicons, words
+
+
+def distance_limit(spec: Union[int, float, str], length: int) -> int:
+    """Interprets an analiticcl distance threshold: an absolute number, a ratio of the length, or 'ratio;limit'"""
+    if isinstance(spec, str) and ";" in spec:
+        ratio, limit = spec.split(";")
+        return min(math.ceil(float(ratio) * length), int(limit))
+    elif isinstance(spec, float) or (isinstance(spec, str) and "." in spec):
+        return math.ceil(float(spec) * length)
+    return int(spec)
+
+
+def within_distance(a: str, b: str, k: int) -> bool:
+    """Is the Levenshtein distance between a and b at most k?"""
+    if abs(len(a) - len(b)) > k:
+        return False
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i] + [0] * len(b)
+        for j, cb in enumerate(b, 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb))
+        if min(current) > k:
+            return False
+        previous = current
+    return previous[-1] <= k
+
+
+def affected_tokens(tokens: Iterable[str], words: Set[str], max_edit_distance) -> Set[str]:
+    """Returns the tokens that are within the maximum edit distance of any of the (changed) words"""
+    affected = set()
+    for token in tokens:
+        for word in words:
+            if within_distance(token, word, distance_limit(max_edit_distance, max(len(token), len(word)))):
+                affected.add(token)
+                break
+    return affected
+
+
+def read_annotations(filename: str) -> List[dict]:
+    with open_input(filename) as f:
+        if uncompressed_name(filename).endswith(".jsonl"):
+            return [json.loads(line) for line in f if line.strip()]
+        return json.load(f)
+
+
+def write_annotations(filename: str, annotations: List[dict]):
+    with open_output(filename) as f:
+        if uncompressed_name(filename).endswith(".jsonl"):
+            for annotation in annotations:
+                f.write(dumps_jsonl(annotation))
+        else:
+            json.dump(obj=annotations, fp=f, indent=4, ensure_ascii=False)
+
+
+def retag_scan(ner: NER, lineindex: LineIndex, scan: int, lines: Set[int]) -> bool:
+    """Tags the given lines of a scan again and merges the new annotations into its annotation file, replacing the
+    old annotations of those lines. Returns False if the scan's annotation file is missing."""
+    scan_row = lineindex.scan(scan)
+    annotationfile = json.loads(scan_row['outputs'])[0]
+    if not os.path.exists(annotationfile):
+        print(f"WARNING: {annotationfile} no longer exists, skipping", file=sys.stderr)
+        return False
+    rows = lineindex.scan_lines(scan)
+    affected = [row for row in rows if row['id'] in lines]
+    batch_results = ner.find_all_matches_batch([row['text'] for row in affected])
+    # all new annotations of a scan share one timestamp
+    ner.timestamp = now()
+    target = SimpleNamespace(pid=scan_row['pid'], text_pid=scan_row['text_pid'])
+    new_annotations: Dict[int, List[dict]] = {}
+    for row, ner_results in zip(affected, batch_results):
+        text_line = TextLine(row['line_id'], row['raw_text'], Box(row['x'], row['y'], row['w'], row['h']))
+        annotations = ner.annotate_line(target, text_line, row['text'], ner_results, row['line_offset'])
+        new_annotations[row['id']] = annotations
+        lineindex.update_line(row['id'], NER.line_record(text_line, row['text'], row['line_offset'], ner_results,
+                                                         annotations))
+    old_annotations = {annotation['id']: annotation for annotation in read_annotations(annotationfile)}
+    merged = []
+    for row in rows:
+        if row['id'] in new_annotations:
+            merged += new_annotations[row['id']]
+        else:
+            merged += [old_annotations[x] for x in json.loads(row['annotations']) if x in old_annotations]
+    print(f"writing to {annotationfile}", file=sys.stderr)
+    write_annotations(annotationfile, merged)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Re-tag only the lines that may be affected by changes to lexicons, variant lists or context "
+                    "rules, and merge the results into the existing annotation files. Requires a line index recorded "
+                    "by golden-agents-ner --line-index. Affected are all lines with a token within the maximum edit "
+                    "distance of a word in a changed row, and, for changed context rules, all lines with matches from "
+                    "a lexicon the rule refers to. Changes to other settings (search parameters, weights, HTR "
+                    "corrections, etc.) require a full run.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--config', '-c', type=str, help="Configuration file referring to the changed resources",
+                        action='store', required=True)
+    parser.add_argument('--index', '-i', type=str, action='append', required=True,
+                        help="Line index of a previous run (may be specified multiple times, e.g. for shards)")
+    parser.add_argument('--diff', type=str, nargs=2, metavar=("OLD", "NEW"), action='append', required=True,
+                        help="A changed resource: a copy of its previous version and the resource itself (may be "
+                             "specified multiple times)")
+    parser.add_argument('--manifest', type=str, action='append', required=False,
+                        help="Manifest of the previous run, updated so that --resume considers the outputs valid for "
+                             "the new configuration (may be specified multiple times)")
+    parser.add_argument('--threads', '-t', type=int, help="Number of threads to match the lines of a scan with",
+                        action='store', default=1)
+    parser.add_argument('--dry-run', '-n', help="Only report how many lines and scans are affected",
+                        action='store_true', required=False)
+    args = parser.parse_args()
+
+    config = NER.read_config(args.config)
+    contextrules = os.path.realpath(fixpath(config['contextrules'], args.config)) if config.get('contextrules') else None
+    changed_words: Set[str] = set()
+    changed_lexicons: Set[str] = set()
+    for oldfile, newfile in args.diff:
+        rows = changed_rows(oldfile, newfile)
+        print(f"{newfile}: {len(rows)} changed rows", file=sys.stderr)
+        for row in rows:
+            if os.path.realpath(newfile) == contextrules:
+                lexicons, words = rule_references(row)
+                changed_lexicons |= lexicons
+                changed_words |= words
+            else:
+                changed_words |= row_words(row)
+    max_edit_distance = config['searchparameters'].get('max_edit_distance', 3)
+
+    ner = None
+    for indexfile in args.index:
+        lineindex = LineIndex(indexfile)
+        tokens = affected_tokens(lineindex.tokens(), changed_words, max_edit_distance)
+        lines = lineindex.lines_with_tokens(tokens)
+        if changed_lexicons:
+            lines |= lineindex.lines_with_sources(source for source in lineindex.sources()
+                                                  if os.path.basename(source) in changed_lexicons)
+        scans = lineindex.scans_of_lines(lines)
+        print(f"{indexfile}: {len(tokens)} affected tokens, {len(lines)} affected lines in {len(scans)} scans",
+              file=sys.stderr)
+        if not args.dry_run and scans:
+            if ner is None:
+                ner = NER(args.config, threads=args.threads)
+            for scan, scan_lines in scans.items():
+                retag_scan(ner, lineindex, scan, scan_lines)
+                lineindex.commit()
+        lineindex.close()
+
+    if args.manifest and not args.dry_run:
+        if ner is None:
+            ner = NER(args.config, threads=args.threads)
+        for manifestfile in args.manifest:
+            manifest = Manifest(manifestfile, config_hash="")
+            for inputfile, entry in list(manifest.entries.items()):
+                # keep the output format (and compression)
+                output_format = entry['config'].split(":", 1)[-1]
+                manifest.update_config(inputfile, f"{ner.fingerprint()}:{output_format}")
+            manifest.close()
+    if ner is not None:
+        ner.print_statistics()
+
+
+if __name__ == '__main__':
+    main()
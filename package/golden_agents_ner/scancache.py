@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os.path
+import sys
+from collections import namedtuple
+from typing import Dict, Iterator, List
+
+from golden_agents_ner.manifest import atomic_open
+from golden_agents_ner.ner import ARCHIVE_IDENTIFIERS, NoArchiveIDError, create_scan_id, read_archive_identifiers, \
+    scan_pids
+from golden_agents_ner.pagexmlreader import TextLine, read_pagexml_file
+
+# Suffix of the scan cache files, input files ending in this suffix are read as scan caches rather than PageXML
+SCANCACHE_SUFFIX = ".scans.jsonl"
+
+# Bounding box of a line, all the NER needs from the coordinates
+Box = namedtuple('Box', ('x', 'y', 'w', 'h'))
+
+
+class CachedScan:
+    """A scan read from a scan cache: the lines (id, bounding box, text) and persistent identifiers that were extracted
+    from the PageXML file beforehand. Can be passed to the NER like any parsed scan."""
+
+    def __init__(self, record: dict, source: str):
+        self.filename = record['file']
+        self.source = source
+        self.id = record['id']
+        self.pid = record['pid']
+        self.text_pid = record['text_pid']
+        self.lines = [TextLine(line_id, text, Box(x, y, w, h)) for line_id, text, x, y, w, h in record['lines']]
+
+    def get_lines(self) -> List[TextLine]:
+        return self.lines
+
+
+def is_scancache(filename: str) -> bool:
+    return filename.endswith(SCANCACHE_SUFFIX)
+
+
+def iter_cached_scans(cachefile: str) -> Iterator[CachedScan]:
+    """Yields the scans from a scan cache file, in the order they were extracted"""
+    with open(cachefile, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield CachedScan(json.loads(line), cachefile)
+
+
+def extract_scan(pagexmlfile: str, archive_identifier: Dict[str, str], stream: bool = True) -> dict:
+    """Reads a PageXML file like NER.read_pagexml() does and returns the record to store in the scan cache. Only
+    lines with text are kept, the NER skips the others anyway."""
+    if os.path.islink(pagexmlfile):
+        # deference symbolic links, we need the full path info
+        pagexmlfile = os.path.realpath(pagexmlfile)
+    scan = read_pagexml_file(pagexmlfile, stream=stream)
+    pid, text_pid = scan_pids(pagexmlfile, archive_identifier)
+    return {
+        "file": pagexmlfile,
+        "id": scan.id or create_scan_id(pagexmlfile),
+        "pid": pid,
+        "text_pid": text_pid,
+        "lines": [[line.id, line.text, line.coords.x, line.coords.y, line.coords.w, line.coords.h]
+                  for line in scan.get_lines() if line.text],
+    }
+
+
+def cachefile_for(cachedir: str, pagexmlfile: str) -> str:
+    """Scans are cached in one file per archive (the directory the PageXML file is in)"""
+    archive = os.path.basename(os.path.dirname(os.path.realpath(pagexmlfile)))
+    return os.path.join(cachedir, f"{archive}{SCANCACHE_SUFFIX}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Extract the lines (ids, coordinates and text) and the persistent identifiers of PageXML scans "
+                    "into a scan cache, one JSON Lines file per archive. Pass the cache files to golden-agents-ner "
+                    "instead of the PageXML files to skip XML parsing, e.g. in parameter sweeps. Re-extract when the "
+                    "PageXML files or the archive identifiers change.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--config', '-c', type=str,
+                        help="NER configuration file (for the archive identifiers and the PageXML parser)",
+                        action='store', required=True)
+    parser.add_argument('--destinationdir', '-d', type=str, help="Directory to write the scan cache files to",
+                        action='store', required=True)
+    parser.add_argument("pagexmlfiles", nargs="+", type=str,
+                        help="The PageXML file(s) to extract, may also be .lst or .index files listing PageXML files")
+    args = parser.parse_args()
+
+    from golden_agents_ner.cli import iter_inputfiles
+    with open(args.config, 'rb') as f:
+        config = json.load(f)
+    if ARCHIVE_IDENTIFIERS not in config:
+        parser.error(f"config file should have an '{ARCHIVE_IDENTIFIERS}' entry")
+    archive_identifier = read_archive_identifiers(config[ARCHIVE_IDENTIFIERS])
+    stream = config.get('pagexml-parser', 'stream') == 'stream'
+
+    cachefiles: Dict[str, List[str]] = {}
+    for pagexmlfile in iter_inputfiles(*args.pagexmlfiles):
+        cachefiles.setdefault(cachefile_for(args.destinationdir, pagexmlfile), []).append(pagexmlfile)
+    os.makedirs(args.destinationdir, exist_ok=True)
+    for cachefile, pagexmlfiles in cachefiles.items():
+        count = 0
+        with atomic_open(cachefile) as f:
+            for pagexmlfile in pagexmlfiles:
+                try:
+                    record = extract_scan(pagexmlfile, archive_identifier, stream)
+                except NoArchiveIDError:
+                    print(f"ERROR: Unable to process {pagexmlfile}, does not have an archive identifier! Skipping...",
+                          file=sys.stderr)
+                    continue
+                f.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n")
+                count += 1
+        print(f"Wrote {count} scans to {cachefile}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
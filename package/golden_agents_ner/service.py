@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import List, Optional, Tuple
+
+from golden_agents_ner.ner import NER, NoArchiveIDError, create_scan_id, scan_pids
+from golden_agents_ner.pagexmlreader import read_pagexml_file
+
+try:
+    import uvicorn
+    from fastapi import FastAPI, HTTPException, Request
+    from pydantic import BaseModel
+except ImportError:
+    FastAPI = None
+
+
+class LinesScan:
+    """A scan made up of plain lines of text passed to the service, without coordinates"""
+
+    def __init__(self, lines: List[str], pid: str, text_pid: str):
+        self.id = pid
+        self.pid = pid
+        self.text_pid = text_pid
+        self.lines = [SimpleNamespace(id=f"line{i}", text=line, coords=SimpleNamespace(x=0, y=0, w=0, h=0))
+                      for i, line in enumerate(lines)]
+
+    def get_lines(self):
+        return self.lines
+
+
+class Tagger:
+    """Tags scans with a loaded NER model on behalf of concurrent requests.
+
+    Requests are queued and gathered into batches: a batch is closed when it holds max_batch_lines lines or when
+    batch_delay seconds have passed since its first request. The lines of all scans in a batch are matched at once,
+    spread over the NER's matching threads. The NER itself is only ever used from a single thread, so batches are
+    processed one at a time. When max_pending requests are waiting, further requests are refused."""
+
+    def __init__(self, ner: NER, max_batch_lines: int = 2000, batch_delay: float = 0.005, max_pending: int = 64):
+        self.ner = ner
+        self.max_batch_lines = max_batch_lines
+        self.batch_delay = batch_delay
+        self.max_pending = max_pending
+        self.queue: Optional[asyncio.Queue] = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.task = None
+
+    def start(self):
+        self.queue = asyncio.Queue(maxsize=self.max_pending)
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+        self.executor.shutdown(wait=False)
+
+    async def tag(self, scan) -> Tuple[List[dict], str, List[dict]]:
+        """Tags a scan, returns the annotations, the plain text and the raw results. Raises asyncio.QueueFull if too
+        many requests are pending."""
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((scan, sum(1 for line in scan.get_lines() if line.text), future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            jobs = [await self.queue.get()]
+            lines = jobs[0][1]
+            deadline = loop.time() + self.batch_delay
+            while lines < self.max_batch_lines:
+                try:
+                    job = await asyncio.wait_for(self.queue.get(), max(deadline - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    break
+                jobs.append(job)
+                lines += job[1]
+            try:
+                results = await loop.run_in_executor(self.executor, self.tag_batch, [scan for scan, _, _ in jobs])
+            except Exception as e:
+                for _, _, future in jobs:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                # an error in one scan only fails the request for that scan
+                for (_, _, future), result in zip(jobs, results):
+                    if future.done():
+                        continue
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+
+    def tag_batch(self, scans: list) -> list:
+        # runs on the NER thread
+        results = self.ner.create_web_annotations_batch(scans, return_exceptions=True)
+        self.ner.statistics['batches'] += 1
+        return results
+
+    async def statistics(self) -> dict:
+        """Returns a copy of the NER statistics, which is taken on the NER thread as batches update them"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, dict, self.ner.statistics)
+
+
+def create_app(ner: NER, max_batch_lines: int = 2000, batch_delay: float = 0.005, max_pending: int = 64):
+    """Creates the web application around a loaded NER model"""
+    tagger = Tagger(ner, max_batch_lines, batch_delay, max_pending)
+    app = FastAPI()
+
+    class LinesBody(BaseModel):
+        lines: List[str]
+        scan_pid: Optional[str] = None
+        text_pid: Optional[str] = None
+        raw: bool = False
+
+    @app.on_event("startup")
+    async def startup():
+        tagger.start()
+
+    @app.on_event("shutdown")
+    async def shutdown():
+        await tagger.stop()
+
+    async def tag(scan, raw: bool) -> dict:
+        try:
+            annotations, plain_text, raw_results = await tagger.tag(scan)
+        except asyncio.QueueFull:
+            raise HTTPException(status_code=503, detail="Too many pending requests, try again later")
+        except Exception as e:
+            raise HTTPException(status_code=422, detail=f"Unable to tag the scan: {e}")
+        if raw:
+            return {"results": raw_results, "text": plain_text}
+        return {"annotations": annotations, "text": plain_text}
+
+    @app.get("/")
+    async def root():
+        return {"message": "This is the Golden Agents NER tagging service", "config": ner.configfile,
+                "fingerprint": ner.fingerprint()}
+
+    @app.post("/tag/lines")
+    async def tag_lines(body: LinesBody):
+        """Tags plain lines of text"""
+        scan_pid = body.scan_pid or "urn:golden-agents:service:scan"
+        return await tag(LinesScan(body.lines, scan_pid, body.text_pid or scan_pid), body.raw)
+
+    @app.post("/tag/pagexml")
+    async def tag_pagexml(request: Request, path: str, raw: bool = False):
+        """Tags a PageXML document posted as the request body. The path is the (original) path of the PageXML
+        file, at least the archive directory and the filename, from which the persistent identifiers are derived"""
+        try:
+            pid, text_pid = scan_pids(path, ner.archive_identifier)
+        except (NoArchiveIDError, IndexError):
+            raise HTTPException(status_code=422, detail=f"No archive identifier for {path}")
+        data = await request.body()
+        stream = ner.config.get('pagexml-parser', 'stream') == 'stream'
+        try:
+            scan = await asyncio.get_running_loop().run_in_executor(None, read_pagexml_file, path, stream, data)
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Unable to parse PageXML: {e}")
+        if not scan.id:
+            scan.id = create_scan_id(path)
+        scan.pid, scan.text_pid = pid, text_pid
+        return await tag(scan, raw)
+
+    @app.get("/statistics")
+    async def statistics():
+        return await tagger.statistics()
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="HTTP service that tags PageXML documents or plain lines with a NER model that is loaded once at "
+                    "startup, returning web annotations or raw results",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--config', '-c', type=str, help="Configuration file", action='store', required=True)
+    parser.add_argument('--host', type=str, help="Host to listen on", action='store', default="127.0.0.1")
+    parser.add_argument('--port', '-p', type=int, help="Port to listen on", action='store', default=8001)
+    parser.add_argument('--threads', '-t', type=int, help="Number of threads to match the lines of a batch with",
+                        action='store', default=4)
+    parser.add_argument('--matchcache-size', type=int,
+                        help="Maximum number of lines for which the matching results are cached in memory",
+                        action='store', default=100000)
+    parser.add_argument('--max-batch-lines', type=int, help="Maximum number of lines to match in one batch",
+                        action='store', default=2000)
+    parser.add_argument('--batch-delay', type=float,
+                        help="Time (in seconds) to wait for more requests to add to a batch",
+                        action='store', default=0.005)
+    parser.add_argument('--max-pending', type=int,
+                        help="Maximum number of requests waiting to be tagged, more are refused (503)",
+                        action='store', default=64)
+    args = parser.parse_args()
+    if FastAPI is None:
+        print("ERROR: The service requires fastapi and uvicorn (pip install golden_agents_ner[service])",
+              file=sys.stderr)
+        sys.exit(2)
+    if args.threads < 1:
+        parser.error("--threads must be at least 1")
+    ner = NER(args.config, matchcache_size=args.matchcache_size, threads=args.threads)
+    app = create_app(ner, args.max_batch_lines, args.batch_delay, args.max_pending)
+    uvicorn.run(app, host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
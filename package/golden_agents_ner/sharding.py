@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+import argparse
+import hashlib
+import json
+import sys
+from collections import Counter
+from typing import Iterable, Iterator, Tuple, Dict
+
+from golden_agents_ner.manifest import Manifest, atomic_open
+
+
+def parse_shard(spec: str) -> Tuple[int, int]:
+    """Parses a shard specification K/N (1 <= K <= N)"""
+    try:
+        k, n = (int(x) for x in spec.split('/'))
+    except ValueError:
+        raise ValueError(f"Invalid shard specification '{spec}', expected K/N, e.g. 1/4")
+    if n < 1 or not 1 <= k <= n:
+        raise ValueError(f"Invalid shard specification '{spec}', expected 1 <= K <= N")
+    return k, n
+
+
+def shard_key(pagexmlfile: str) -> str:
+    """The key a file is assigned to a shard by: the archive directory and the filename, so the assignment does not
+    depend on where the data is mounted"""
+    return '/'.join(pagexmlfile.split('/')[-2:])
+
+
+def in_shard(pagexmlfile: str, k: int, n: int) -> bool:
+    """Is the file part of shard K (of N)? The assignment is hash-based, so it is stable when files are added"""
+    digest = hashlib.sha1(shard_key(pagexmlfile).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % n == k - 1
+
+
+def select_shard(pagexmlfiles: Iterable[str], k: int, n: int) -> Iterator[str]:
+    for pagexmlfile in pagexmlfiles:
+        if in_shard(pagexmlfile, k, n):
+            yield pagexmlfile
+
+
+def merge_manifests(manifestfiles: Iterable[str]) -> Dict[str, dict]:
+    """Combines the entries of multiple manifests, entries in later manifests supersede those in earlier ones"""
+    entries = {}
+    for manifestfile in manifestfiles:
+        for key, entry in Manifest.read(manifestfile).items():
+            if key in entries and entries[key]['config'] != entry['config']:
+                print(f"WARNING: {key} was processed with different configurations, using the one from {manifestfile}",
+                      file=sys.stderr)
+            entries[key] = entry
+    return entries
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Merge the manifests of (sharded) golden-agents-ner runs and report the combined statistics "
+                    "(as JSON on standard output)",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--output', '-o', type=str, help="Write the merged manifest to this file", action='store',
+                        required=False)
+    parser.add_argument("manifests", nargs="+", help="Manifest files to merge", type=str)
+    args = parser.parse_args()
+
+    entries = merge_manifests(args.manifests)
+    statistics = Counter()
+    for entry in entries.values():
+        statistics.update(entry.get('statistics', {}))
+    if args.output:
+        with atomic_open(args.output) as f:
+            for entry in entries.values():
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        print(f"Wrote {len(entries)} entries to {args.output}", file=sys.stderr)
+    json.dump({"inputs": len(entries), "configs": sorted(set(e['config'] for e in entries.values())),
+               "statistics": dict(sorted(statistics.items()))}, sys.stdout, indent=4)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+import argparse
+import os.path
+import sys
+import time
+from types import SimpleNamespace
+
+from golden_agents_ner.cli import parsefiles
+from golden_agents_ner.manifest import Manifest, manifest_filename
+from golden_agents_ner.ner import NER
+
+
+def config_infix(configfile: str) -> str:
+    """Derives the infix of a configuration from its filename: nerconfig.exp14a.json -> exp14a"""
+    name = os.path.basename(configfile)
+    if name.endswith(".json"):
+        name = name[:-len(".json")]
+    if name.startswith("nerconfig."):
+        name = name[len("nerconfig."):]
+    return name
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run the NER with several configurations (a parameter sweep) in one process. The model is built "
+                    "once and only rebuilt when a configuration changes the alphabet, weights, lexicons, variant lists, "
+                    "language models or context rules; other changes, like the search parameters, are applied to the "
+                    "existing model. The output of each configuration goes to its own directory, named after the "
+                    "infix derived from the configuration file (nerconfig.exp14a.json -> exp14a)",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--config', '-c', type=str, nargs='+',
+                        help="Configuration files, processed in the given order (order them so configurations sharing "
+                             "a model are adjacent)",
+                        action='store', required=True)
+    parser.add_argument('--destinationdir', '-d', type=str,
+                        help="Directory in which a subdirectory per configuration is created for the output files",
+                        action='store', default=".")
+    parser.add_argument('--format', '-f', type=str, choices=('json', 'jsonl'), help="Output format",
+                        action='store', default='json')
+    parser.add_argument('--workers', '-j', type=int, help="Number of worker processes", action='store', default=1)
+    parser.add_argument('--threads', '-t', type=int, help="Number of threads to match the lines of a scan with",
+                        action='store', default=1)
+    parser.add_argument('--matchcache-size', type=int,
+                        help="Maximum number of lines for which the matching results are cached in memory",
+                        action='store', default=10000)
+    parser.add_argument('--resume', help="Skip input files that were already processed with the same configuration",
+                        action='store_true', required=False)
+    parser.add_argument("pagexmlfiles", nargs="+", type=str,
+                        help="The PageXML file(s) or scan cache files (see golden-agents-ner-extract) to process")
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.threads < 1:
+        parser.error("--threads must be at least 1")
+    infixes = [config_infix(configfile) for configfile in args.config]
+    if len(set(infixes)) != len(infixes):
+        parser.error("The configuration files must have distinct names, their output directories are named after them")
+
+    ner = None
+    builds = 0
+    for configfile, infix in zip(args.config, infixes):
+        print(f"--- {infix} ({configfile}) ---", file=sys.stderr)
+        if ner is None or not ner.reconfigure(configfile):
+            ner = None  # release the previous model before building the next
+            ner = NER(configfile, matchcache_size=args.matchcache_size, threads=args.threads)
+            builds += 1
+        else:
+            print(f"Reusing the model for {infix}", file=sys.stderr)
+        out_root = os.path.join(args.destinationdir, infix)
+        os.makedirs(out_root, exist_ok=True)
+        variant_args = SimpleNamespace(infix=infix, stdout=False, rawout=False, format=args.format,
+                                       workers=args.workers, shard=None, resume=args.resume)
+        manifest = Manifest(manifest_filename(out_root, infix), config_hash=f"{ner.fingerprint()}:{args.format}")
+        start = time.perf_counter()
+        parsefiles(ner, out_root, variant_args, *args.pagexmlfiles, manifest=manifest)
+        manifest.close()
+        ner.print_statistics(statistics=ner.pop_statistics(), elapsed=time.perf_counter() - start)
+    print(f"Ran {len(infixes)} configurations with {builds} model builds", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
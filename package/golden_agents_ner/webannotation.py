@@ -0,0 +1,55 @@
+"""Constant parts of the web annotations produced by the NER tagger.
+
+These structures are shared by all annotations rather than being rebuilt for each one; they must not be modified.
+Sequences are tuples, which serialise to JSON arrays."""
+from functools import lru_cache
+from typing import Dict, Any
+
+ANNOTATION_CONTEXT = "http://www.w3.org/ns/anno.jsonld"
+OBSERVATION_CONTEXT = (ANNOTATION_CONTEXT, {"prov": "http://www.w3.org/ns/prov#"})
+
+GENERATOR = {
+    "id": "https://github.com/knaw-huc/golden-agents-htr",
+    "type": "Software",
+    "name": "GoldenAgentsNER"
+}
+
+MOTIVATION_CLASSIFYING = ("classifying",)
+MOTIVATION_CLASSIFYING_EDITING = ("classifying", "editing")
+
+MEDIA_FRAGMENTS = "http://www.w3.org/TR/media-frags/"
+
+
+@lru_cache(maxsize=256)
+def image_target(scan_pid: str, xywh: str) -> Dict[str, Any]:
+    """Returns the image target for a region of a scan; all annotations on the same text line share it"""
+    return {
+        "source": scan_pid,
+        "type": "Image",
+        "selector": {
+            "type": "FragmentSelector",
+            "conformsTo": MEDIA_FRAGMENTS,
+            "value": f"xywh={xywh}"
+        }
+    }
+
+
+def text_target(text_pid: str, line_text: str, line_offset: int, begin: int, end: int) -> Dict[str, Any]:
+    """Returns the text target for the span begin-end of a text line (offsets relative to the line)"""
+    return {
+        "source": text_pid,
+        "type": "Text",
+        "selector": [
+            {
+                "type": "TextPositionSelector",
+                "start": line_offset + begin,
+                "end": line_offset + end
+            },
+            {
+                "type": "TextQuoteSelector",
+                "exact": line_text[begin:end],
+                "prefix": line_text[:begin],
+                "suffix": line_text[end:],
+            }
+        ]
+    }
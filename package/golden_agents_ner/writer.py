@@ -0,0 +1,159 @@
+import gzip
+import io
+import sys
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Callable, Deque, List, Optional, TextIO, Tuple
+
+from golden_agents_ner.manifest import atomic_open
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Suffixes of compressed output files, by compression method
+COMPRESSION_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+
+# An output file to write: its filename and a function that serialises the content to an open (text) file
+Write = Tuple[str, Callable[[TextIO], None]]
+
+
+def compression_of(filename: str) -> Optional[str]:
+    """Returns the compression method of a file, by its suffix, or None if it is not compressed"""
+    for compression, suffix in COMPRESSION_SUFFIXES.items():
+        if filename.endswith(suffix):
+            return compression
+    return None
+
+
+def uncompressed_name(filename: str) -> str:
+    """Strips the compression suffix (if any) from a filename: A16097000219.json.gz -> A16097000219.json"""
+    compression = compression_of(filename)
+    return filename[:-len(COMPRESSION_SUFFIXES[compression])] if compression else filename
+
+
+def check_compression(compression: Optional[str]):
+    """Raises a ValueError if the compression method is not available"""
+    if compression is not None and compression not in COMPRESSION_SUFFIXES:
+        raise ValueError(f"Unknown compression method: {compression}")
+    if compression == "zstd" and zstandard is None:
+        raise ValueError("zstd compression requires the zstandard package (pip install zstandard)")
+
+
+@contextmanager
+def open_output(filename: str, fsync: bool = False):
+    """Opens an output file for writing text, atomically (see atomic_open()), compressed according to its suffix"""
+    compression = compression_of(filename)
+    if compression is None:
+        with atomic_open(filename, fsync=fsync) as f:
+            yield f
+        return
+    with atomic_open(filename, 'wb', fsync=fsync) as raw:
+        if compression == "gzip":
+            # no timestamp in the header, so identical output gives identical files
+            stream = gzip.GzipFile(fileobj=raw, mode='wb', mtime=0)
+        else:
+            stream = zstandard.ZstdCompressor().stream_writer(raw, closefd=False)
+        # closing the wrapper finishes the compressed stream, but leaves the underlying file open
+        with io.TextIOWrapper(stream, encoding='utf8') as f:
+            yield f
+
+
+def open_input(filename: str) -> TextIO:
+    """Opens a (possibly compressed) output file for reading text"""
+    compression = compression_of(filename)
+    if compression == "gzip":
+        return gzip.open(filename, 'rt', encoding='utf8')
+    elif compression == "zstd":
+        check_compression(compression)
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'), closefd=True),
+                                encoding='utf8')
+    return open(filename, 'r', encoding='utf8')
+
+
+def write_outputs(writes: List[Write], fsync: bool = False) -> float:
+    """Writes the output files, returns the time it took (in seconds)"""
+    start = perf_counter()
+    for filename, serialize in writes:
+        print(f'writing to {filename}', file=sys.stderr)
+        with open_output(filename, fsync=fsync) as f:
+            serialize(f)
+    return perf_counter() - start
+
+
+class OutputWriter:
+    """Writes output files on a background thread, so the next scan can be tagged meanwhile.
+
+    Submitted writes are carried out one at a time, in order. At most max_pending submissions wait to be written,
+    submitting more blocks until the oldest is done. Callbacks registered with when_written() are run on the calling
+    thread (in submission order) once everything submitted before them is written, so the manifest only lists files
+    that are complete; they get the time spent writing (serialising included) since the previous callback. An error while writing is raised again by the next call of submit(), when_written() or
+    close(), and nothing submitted after it is written. With max_pending 0, everything is written synchronously by
+    submit()."""
+
+    def __init__(self, max_pending: int = 8, fsync: bool = False):
+        self.max_pending = max_pending
+        self.fsync = fsync
+        self.pending: Deque[Tuple[Future, list]] = deque()
+        self.executor = ThreadPoolExecutor(max_workers=1) if max_pending > 0 else None
+        self.failed = False
+        # time spent writing that has not been passed to a callback yet
+        self.write_time = 0.0
+
+    def submit(self, writes: List[Write]):
+        if self.executor is None:
+            self.write_time += write_outputs(writes, self.fsync)
+            return
+        self.pending.append((self.executor.submit(self._write, writes), []))
+        self._collect(self.max_pending)
+
+    def _write(self, writes: List[Write]) -> float:
+        # runs on the background thread
+        if self.failed:
+            return 0.0
+        try:
+            return write_outputs(writes, self.fsync)
+        except BaseException:
+            self.failed = True
+            raise
+
+    def when_written(self, callback: Callable, *args):
+        """Calls the callback once all writes submitted so far are done, with the time spent writing followed by
+        args"""
+        if self.pending:
+            self.pending[-1][1].append((callback, args))
+        else:
+            self._call(callback, args)
+
+    def _call(self, callback: Callable, args: tuple):
+        write_time, self.write_time = self.write_time, 0.0
+        callback(write_time, *args)
+
+    def _collect(self, max_pending: int):
+        """Handles completed writes, waiting for the oldest ones while more than max_pending are pending"""
+        while self.pending and (len(self.pending) > max_pending or self.pending[0][0].done()):
+            future, callbacks = self.pending.popleft()
+            self.write_time += future.result()
+            for callback, args in callbacks:
+                self._call(callback, args)
+
+    def close(self):
+        """Waits for all pending writes"""
+        try:
+            self._collect(0)
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.executor is not None:
+            # finish what was submitted, but do not record it
+            self.executor.shutdown(wait=True)
@@ -22,9 +22,20 @@ setup(
 
     packages=find_packages(exclude=('tests', 'docs')),
 
+    extras_require={
+        'service': ['fastapi', 'uvicorn'],
+    },
+
     entry_points={
         'console_scripts': [
-            'golden-agents-ner = golden_agents_ner.cli:main'
+            'golden-agents-ner = golden_agents_ner.cli:main',
+            'golden-agents-ner-merge = golden_agents_ner.sharding:main',
+            'golden-agents-ner-benchmark = golden_agents_ner.benchmark:main',
+            'golden-agents-ner-extract = golden_agents_ner.scancache:main',
+            'golden-agents-ner-sweep = golden_agents_ner.sweep:main',
+            'golden-agents-ner-service = golden_agents_ner.service:main',
+            'golden-agents-ner-retag = golden_agents_ner.retag:main',
+            'golden-agents-ner-query = golden_agents_ner.lineindex:main',
         ]
     }
 )